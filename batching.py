@@ -0,0 +1,79 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    # Собирает запросы из разных потоков в один батч и выполняет их
+    # в единственном рабочем потоке: модель никогда не вызывается параллельно.
+    # workers > 1 — только для run_batch, который сам безопасен для параллельных
+    # вызовов (например, отдает батч в пул процессов).
+
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=5.0, name="batcher", workers=1):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size должен быть >= 1")
+        if workers < 1:
+            raise ValueError("workers должен быть >= 1")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0) / 1000.0
+        self.name = name
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._loop, name=f"{self.name}-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def submit(self, item):
+        future = Future()
+        self._ensure_started()
+        self._queue.put((item, future))
+        return future
+
+    def predict(self, item, timeout=None):
+        return self.submit(item).result(timeout)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                results = self.run_batch([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"{self.name}: получено {len(results)} результатов на батч из {len(batch)}")
+            except Exception as e:
+                logging.error(f"Ошибка батча {self.name}: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,90 @@
+# Сравнение requests.post на каждый вызов с общей сессией http_client
+# на локальной заглушке /chat/completions.
+#
+#   python bench/bench_http.py --requests 500 --threads 8 --latency-ms 2
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client  # noqa: E402
+
+RESPONSE = json.dumps({"choices": [{"message": {"content": "Привет!"}}]}).encode("utf-8")
+
+
+def make_handler(latency):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        connections = set()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            StubHandler.connections.add(self.client_address)
+            if latency:
+                time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(RESPONSE)))
+            self.end_headers()
+            self.wfile.write(RESPONSE)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+def run(name, post, url, total, threads):
+    payload = {"model": "stub", "messages": [{"role": "user", "content": "Привет"}]}
+
+    def one(_):
+        start = time.perf_counter()
+        post(url, json=payload, timeout=(5, 30)).json()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        latencies = sorted(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+    return {
+        "name": name,
+        "requests_per_s": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    handler = make_handler(args.latency_ms / 1000)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/api/v1/chat/completions"
+
+    results = []
+    for name, post in (("requests.post", requests.post), ("http_client.session", http_client.session.post)):
+        handler.connections.clear()
+        result = run(name, post, url, args.requests, args.threads)
+        result["tcp_connections"] = len(handler.connections)
+        results.append(result)
+    server.shutdown()
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
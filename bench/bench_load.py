@@ -0,0 +1,550 @@
+# Нагрузочный прогон бота без сети: локальные заглушки Telegram Bot API
+# и /chat/completions, синтетический поток апдейтов (текст, меню, фото, кнопки)
+# через маршрут вебхука или через polling. Отчет в JSON: p50/p95/p99 от отправки
+# апдейта до доставки последнего ответа на него, апдейтов в секунду, пиковый RSS.
+#
+#   python bench/bench_load.py --mode webhook --chats 50 --actions 10 --llm-latency-ms 300 --output load.json
+#
+# Бот настраивается теми же переменными окружения, что и в проде
+# (WEBHOOK_WORKERS, SEND_CHAT_RATE, LLM_STREAMING, STORAGE_URL...);
+# их значения попадают в отчет, чтобы прогоны можно было сравнивать.
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, ROOT)
+from bench_preprocessing import digit_photo  # noqa: E402
+
+TOKEN = "123456:bench"
+REPORTED_ENV = ("WEBHOOK_WORKERS", "WEBHOOK_MAX_PENDING", "SEND_GLOBAL_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST",
+                "SEND_MERGE_MS", "SEND_WORKERS", "LLM_STREAMING", "LLM_STREAM_EDIT_INTERVAL", "LLM_CACHE",
+                "STORAGE_URL", "INFERENCE_BATCH_SIZE", "INFERENCE_BATCH_WAIT_MS", "INFERENCE_PROCESSES",
+                "POLLING_MODE", "POLLING_BATCH_SIZE", "POLLING_WORKERS", "HTTP_POOL_SIZE")
+MENU = ("Помощь", "Инфо", "О боте", "Игровой автомат")
+QUESTIONS = ("Привет, как дела?", "Расскажи про черные дыры", "Как выучить Python?", "Что такое рекурсия?")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[max(math.ceil(p * len(values)) - 1, 0)] * 1000, 2)
+
+    return {"count": len(values), "p50_ms": rank(0.5), "p95_ms": rank(0.95), "p99_ms": rank(0.99),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def params(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            body = self.rfile.read(length).decode("utf-8")
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+        return url.path, params
+
+
+class FakeTelegram:
+    # Минимальный Bot API: отвечает на методы, которые вызывает бот, отдает файлы
+    # и апдейты для getUpdates с long polling.
+
+    def __init__(self, photos, latency):
+        self.photos = photos
+        self.latency = latency
+        self.calls = Counter()
+        self.updates = []
+        self.cond = threading.Condition()
+        self.message_ids = iter(range(10 ** 9, 2 * 10 ** 9))
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(StubHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            do_POST = do_GET
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def push(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        deadline = time.monotonic() + float(params.get("timeout", 0))
+        with self.cond:
+            while True:
+                # update_id идут подряд с 1, поэтому индекс вычисляется из offset
+                batch = self.updates[max(offset - 1, 0):max(offset - 1, 0) + limit]
+                remaining = deadline - time.monotonic()
+                if batch or remaining <= 0:
+                    return batch
+                self.cond.wait(remaining)
+
+    def message(self, chat_id, **extra):
+        with self.lock:
+            message_id = next(self.message_ids)
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    def handle(self, request):
+        path, params = request.params()
+        if path.startswith(f"/file/bot{TOKEN}/"):
+            self.calls["download_file"] += 1
+            index = int(path.rsplit("/", 1)[1].split(".")[0])
+            return request.reply(self.photos[index % len(self.photos)], "image/jpeg")
+        method = path.rsplit("/", 1)[1]
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return request.reply({"ok": True, "result": self.get_updates(params)})
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = params.get("chat_id", 0)
+        if method in ("sendMessage", "editMessageText"):
+            result = self.message(chat_id, text=params.get("text", ""))
+        elif method == "sendDice":
+            emoji = params.get("emoji", "🎲")
+            result = self.message(chat_id, dice={"emoji": emoji, "value": random.randint(1, 64 if emoji == "🎰" else 6)})
+        elif method == "getFile":
+            result = {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                      "file_path": f"photos/{params['file_id']}.jpg"}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        request.reply({"ok": True, "result": result})
+
+
+class FakeLLM:
+    # /chat/completions: задержка до первого токена, затем tokens кусков через token_interval.
+
+    def __init__(self, latency, tokens, token_interval):
+        self.requests = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(StubHandler):
+            def do_POST(self):
+                _, body = self.params()
+                with fake.lock:
+                    fake.requests += 1
+                fake.handle(self, body, latency, tokens, token_interval)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-llm", daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/v1/chat/completions"
+
+    def handle(self, request, body, latency, tokens, token_interval):
+        words = ["<think>думаю</think>"] + [f"слово{i} " for i in range(tokens)]
+        time.sleep(latency)
+        if not body.get("stream"):
+            time.sleep(token_interval * tokens)
+            return request.reply({"choices": [{"message": {"role": "assistant", "content": "".join(words)}}]})
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Transfer-Encoding", "chunked")
+        request.end_headers()
+        for word in words + [None]:
+            if word is None:
+                data = b"data: [DONE]\n\n"
+            else:
+                chunk = {"choices": [{"delta": {"content": word}}]}
+                data = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+                time.sleep(token_interval)
+            request.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        request.wfile.write(b"0\r\n\r\n")
+
+
+def scenario(rng, mix, actions):
+    # Последовательность апдейтов одного чата: (вид, текст, photo, callback_data).
+    steps = [("text", "/start", None, None), ("text", f"Пользователь{rng.randint(1, 999)}", None, None),
+             ("text", str(rng.randint(10, 80)), None, None)]
+    kinds, weights = zip(*mix.items())
+    for _ in range(actions):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "text":
+            steps.append(("llm", rng.choice(QUESTIONS), None, None))
+        elif kind == "menu":
+            steps.append(("text", rng.choice(MENU), None, None))
+        elif kind == "photo":
+            steps.append(("text", "Распознавание цифр", None, None))
+            steps.append(("photo", None, rng.randrange(10 ** 6), None))
+        elif kind == "callback":
+            if rng.random() < 0.5:
+                steps.append(("text", "Кто хочет стать миллионером", None, None))
+                steps.append(("callback", None, None, f"quiz:square:{rng.randrange(4)}"))
+            else:
+                steps.append(("text", "Игра в кубик", None, None))
+                steps.append(("callback", None, None, str(rng.randint(1, 6))))
+    return steps
+
+
+def build_updates(args, rng):
+    # Чаты перемежаются случайно, порядок внутри чата сохраняется.
+    chats = {1000 + i: scenario(rng, args.mix, args.actions) for i in range(args.chats)}
+    cursors = dict.fromkeys(chats, 0)
+    updates = []
+    while cursors:
+        chat_id = rng.choice(list(cursors))
+        kind, text, photo, data = chats[chat_id][cursors[chat_id]]
+        cursors[chat_id] += 1
+        if cursors[chat_id] == len(chats[chat_id]):
+            del cursors[chat_id]
+        update_id = len(updates) + 1
+        user = {"id": chat_id, "is_bot": False, "first_name": "Bench"}
+        message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                   "from": user}
+        if kind == "callback":
+            update = {"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": data,
+                "message": {**message, "message_id": 1, "text": "?"}}}
+        elif kind == "photo":
+            file_id = str(photo if args.unique_photos else photo % len(args.photo_bytes))
+            update = {"update_id": update_id, "message": {**message, "photo": [
+                {"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 480}]}}
+        else:
+            update = {"update_id": update_id, "message": {**message, "text": text}}
+        updates.append((chat_id, kind, update))
+    return updates
+
+
+def configure_environment(args, workdir):
+    os.environ["API_TOKEN"] = TOKEN
+    os.environ.setdefault("AI_KEY", "bench")
+    os.environ.setdefault("STORAGE_PATH", os.path.join(workdir, "bot.sqlite3"))
+    os.environ.setdefault("LLM_CACHE_PATH", os.path.join(workdir, "llm_cache.sqlite3"))
+    if args.mode == "polling":
+        os.environ.pop("RENDER_EXTERNAL_URL", None)
+    else:
+        os.environ["RENDER_EXTERNAL_URL"] = "http://127.0.0.1"
+
+
+class Tracker:
+    # Время от отправки апдейта до доставки в Telegram последнего ответа на него:
+    # обработчик только ставит ответы в Outbox, поэтому его возврат — еще не конец.
+
+    def __init__(self, updates):
+        self.kinds = {update["update_id"]: kind for _, kind, update in updates}
+        self.started = {}
+        self.local = threading.local()
+        self.latencies = defaultdict(list)
+        self.cond = threading.Condition()
+        self.done = 0
+        self.last = None
+
+    def start(self, update_id):
+        self.started[update_id] = time.perf_counter()
+
+    def finish(self, update_id):
+        now = time.perf_counter()
+        with self.cond:
+            started = self.started.pop(update_id, None)
+            if started is None:
+                return
+            self.latencies[self.kinds[update_id]].append(now - started)
+            self.done += 1
+            self.last = now
+            self.cond.notify_all()
+
+    def wait(self, total, timeout, idle):
+        # Ждет все апдейты, но сдается, если idle секунд ничего не завершалось:
+        # апдейт без подходящего обработчика не завершится никогда.
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.done < total:
+                done = self.done
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait_for(lambda: self.done >= total or self.done != done, min(idle, remaining))
+                if self.done == done:
+                    return False
+            return True
+
+    def wrap(self, handlers):
+        for handler in handlers:
+            handler["function"] = self._tracked(handler["function"])
+
+    def wrap_outbox(self, outbox):
+        # Запоминает Future каждого вызова Outbox, сделанного из обработчика в этом потоке.
+        for name in ("send_message", "call"):
+            setattr(outbox, name, self._captured(getattr(outbox, name)))
+
+    def _captured(self, fn):
+        def wrapper(*args, **kwargs):
+            future = fn(*args, **kwargs)
+            futures = getattr(self.local, "futures", None)
+            if futures is not None:
+                futures.append(future)
+            return future
+        return wrapper
+
+    def _tracked(self, fn):
+        def wrapper(obj, *args, **kwargs):
+            self.local.futures = []
+            try:
+                return fn(obj, *args, **kwargs)
+            finally:
+                futures, self.local.futures = self.local.futures, None
+                # message_id синтетических сообщений и id callback совпадают с update_id
+                self._finish_after(int(obj.id) if hasattr(obj, "chat_instance") else obj.message_id, futures)
+        return wrapper
+
+    def _finish_after(self, update_id, futures):
+        if not futures:
+            return self.finish(update_id)
+        remaining = [len(futures)]
+
+        def delivered(_):
+            with self.cond:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.finish(update_id)
+
+        for future in futures:
+            future.add_done_callback(delivered)
+
+
+def replay_webhook(main, updates, tracker, args):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/{TOKEN}"
+    response_times = []
+    rejected = Counter()
+    start = time.perf_counter()
+
+    def client(shard):
+        # Апдейты одного чата уходят из одного потока по порядку, как их доставляет Telegram.
+        session = requests.Session()
+        for index, (chat_id, _, update) in enumerate(updates):
+            if chat_id % args.concurrency != shard:
+                continue
+            if args.rate:
+                delay = start + index / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            body = json.dumps(update, ensure_ascii=False).encode("utf-8")
+            tracker.start(update["update_id"])
+            while True:
+                sent = time.perf_counter()
+                response = session.post(url, data=body, headers={"Content-Type": "application/json"})
+                response_times.append(time.perf_counter() - sent)
+                if response.status_code != 503:
+                    break
+                rejected[shard] += 1
+                time.sleep(0.1)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return start, {"webhook_response": percentiles(response_times), "rejected_503": sum(rejected.values())}, server.shutdown
+
+
+def replay_polling(main, telegram, updates, tracker, args):
+    start = time.perf_counter()
+
+    def feed():
+        for index, (_, _, update) in enumerate(updates):
+            if args.rate:
+                delay = start + index / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            tracker.start(update["update_id"])
+            telegram.push(update)
+
+    feeder = threading.Thread(target=feed, name="feeder", daemon=True)
+    feeder.start()
+    if main.BATCH_POLLING:
+        main.poller.long_poll = 1
+        target, kwargs, stop = main.poller.run, {}, main.poller.stop
+    else:
+        target, kwargs, stop = main.bot.infinity_polling, {"timeout": 10, "long_polling_timeout": 1}, main.bot.stop_polling
+    threading.Thread(target=target, kwargs=kwargs, name="polling", daemon=True).start()
+    feeder.join()
+    return start, {}, stop
+
+
+def peak_rss_mb():
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+
+def live_children_peak_rss_mb():
+    # RUSAGE_CHILDREN учитывает только завершенные процессы, а процессы пула
+    # инференса живы до конца прогона: их пик (VmHWM) читается из /proc.
+    total = 0
+    try:
+        pids = set()
+        for tid in os.listdir(f"/proc/{os.getpid()}/task"):
+            with open(f"/proc/{os.getpid()}/task/{tid}/children") as f:
+                pids.update(f.read().split())
+        for pid in pids:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+    except OSError:
+        return None
+    return round(total / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        kind, weight = part.split("=")
+        if kind not in ("text", "menu", "photo", "callback"):
+            raise argparse.ArgumentTypeError(f"неизвестный вид апдейта: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--actions", type=int, default=10, help="действий на чат после регистрации")
+    parser.add_argument("--mix", type=parse_mix, default="text=4,menu=3,photo=2,callback=2")
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов в секунду, 0 — без ограничения")
+    parser.add_argument("--concurrency", type=int, default=8, help="потоков-клиентов вебхука")
+    parser.add_argument("--telegram-latency-ms", type=float, default=5)
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="до первого токена")
+    parser.add_argument("--llm-tokens", type=int, default=20)
+    parser.add_argument("--llm-token-ms", type=float, default=10)
+    parser.add_argument("--photos", type=int, default=20, help="разных изображений цифр")
+    parser.add_argument("--unique-photos", action="store_true", help="у каждого фото свой file_unique_id")
+    parser.add_argument("--cold", action="store_true", help="не прогревать модели до начала прогона")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--idle-timeout", type=float, default=30, help="сколько ждать без завершенных апдейтов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл для JSON-отчета, по умолчанию stdout")
+    args = parser.parse_args()
+
+    # git запускается до импорта бота: ru_maxrss потомка учитывает память, унаследованную при fork
+    commit = git_commit()
+    rng = random.Random(args.seed)
+    args.photo_bytes = [digit_photo(i % 10, (640, 480), rng) for i in range(args.photos)]
+    updates = build_updates(args, rng)
+    telegram = FakeTelegram(args.photo_bytes, args.telegram_latency_ms / 1000)
+    llm = FakeLLM(args.llm_latency_ms / 1000, args.llm_tokens, args.llm_token_ms / 1000)
+
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    configure_environment(args, workdir)
+    os.environ["LLM_URL"] = llm.url
+    rss_before = peak_rss_mb()
+    os.chdir(ROOT)
+    import main as bot_main
+    from telebot import apihelper
+    apihelper.API_URL = telegram.url + "/bot{0}/{1}"
+    apihelper.FILE_URL = telegram.url + "/file/bot{0}/{1}"
+
+    if not args.cold:
+        # без прогрева первые фото ждут загрузку моделей (в каждом процессе пула)
+        bot_main.warm_up_models()
+
+    tracker = Tracker(updates)
+    tracker.wrap(bot_main.bot.message_handlers)
+    tracker.wrap(bot_main.bot.callback_query_handlers)
+    tracker.wrap_outbox(bot_main.outbox)
+
+    if args.mode == "webhook":
+        start, extra, stop = replay_webhook(bot_main, updates, tracker, args)
+    else:
+        start, extra, stop = replay_polling(bot_main, telegram, updates, tracker, args)
+    finished = tracker.wait(len(updates), args.timeout, args.idle_timeout)
+    end = tracker.last or time.perf_counter()
+    deadline = time.monotonic() + 30
+    while bot_main.outbox.pending() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    drained = time.perf_counter()
+    children_rss = live_children_peak_rss_mb()
+    stop()
+
+    all_latencies = [v for values in tracker.latencies.values() for v in values]
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": commit,
+        "mode": args.mode,
+        "config": {k: v for k, v in vars(args).items() if k != "photo_bytes"},
+        "env": {name: os.environ[name] for name in REPORTED_ENV if name in os.environ},
+        "updates": len(updates),
+        "completed": tracker.done,
+        "lost": len(updates) - tracker.done,
+        "timed_out": not finished,
+        "wall_s": round(end - start, 3),
+        "updates_per_s": round(tracker.done / (end - start), 1) if end > start else None,
+        "outbox_drain_s": round(drained - end, 3),
+        "latency": {"all": percentiles(all_latencies),
+                    **{kind: percentiles(values) for kind, values in sorted(tracker.latencies.items())}},
+        **extra,
+        "peak_rss_mb": {**peak_rss_mb(), "live_children": children_rss, "before_import": rss_before["self"]},
+        "telegram_calls": dict(telegram.calls.most_common()),
+        "llm_requests": llm.requests,
+        "prediction_cache": bot_main.prediction_cache.stats() if bot_main.prediction_cache is not None else None,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Сравнение preprocessing.py с прежним путем (convert -> ImageOps.fit LANCZOS -> astype / 255)
+# по времени и по точности. Для MNIST берутся настоящие цифры из тестовой выборки,
+# отрисованные как фото листа бумаги (темная цифра на светлом фоне, JPEG), и точность
+# считается по истинным меткам для прежнего пути и для каждого фильтра ресэмплинга.
+#
+#   python bench/bench_preprocessing.py --images 1000 --size 1600x1200
+#   python bench/bench_preprocessing.py --mnist-npz mnist.npz   # без скачивания, формат keras (x_test, y_test)
+
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import preprocessing  # noqa: E402
+
+FILTERS = {
+    "LANCZOS": Image.Resampling.LANCZOS,
+    "BICUBIC": Image.Resampling.BICUBIC,
+    "BILINEAR": Image.Resampling.BILINEAR,
+    "BOX": Image.Resampling.BOX,
+}
+
+
+def reference_mnist(photo):
+    image = preprocessing.open_image(photo).convert("L")
+    image = ImageOps.invert(image)
+    image = ImageOps.fit(image, (28, 28), method=Image.Resampling.LANCZOS)
+    return (np.asarray(image).astype(np.float32) / 255.0).reshape(28, 28, 1)
+
+
+def reference_catdog(photo):
+    image = preprocessing.open_image(photo).convert("RGB")
+    image = ImageOps.fit(image, (150, 150), method=Image.Resampling.LANCZOS)
+    return np.asarray(image).astype(np.float32) / 255.0
+
+
+def load_mnist(path):
+    if path:
+        with np.load(path) as data:
+            return data["x_test"], data["y_test"]
+    from tensorflow.keras.datasets import mnist
+    _, (x_test, y_test) = mnist.load_data()
+    return x_test, y_test
+
+
+def mnist_photo(pixels, size, rng):
+    # Цифра MNIST (белая на черном) -> темная цифра на светлом неровном фоне по центру кадра.
+    background = 220 + rng.randint(0, 30)
+    ink = rng.randint(0, 50)
+    digit = Image.fromarray(pixels).resize((size[1], size[1]), Image.Resampling.BICUBIC)
+    digit = np.asarray(digit, dtype=np.float32) / 255
+    paper = np.full((size[1], size[0]), background, dtype=np.float32)
+    paper += np.linspace(-10, 10, size[0], dtype=np.float32)
+    left = (size[0] - size[1]) // 2
+    area = paper[:, left:left + size[1]]
+    paper[:, left:left + size[1]] = area * (1 - digit) + ink * digit
+    image = Image.fromarray(np.clip(paper, 0, 255).astype(np.uint8)).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def digit_photo(digit, size, rng):
+    # Синтетическая цифра шрифтом по умолчанию: годится как нагрузка
+    # (bench_load.py), но не для оценки точности — модель ее почти не узнает.
+    small = Image.new("L", (40, 40), 235 + rng.randint(0, 20))
+    ImageDraw.Draw(small).text((14, 8), str(digit), fill=rng.randint(0, 40), font=ImageFont.load_default())
+    image = small.resize(size, Image.Resampling.BICUBIC).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def animal_photo(size, rng):
+    image = Image.new("RGB", size, tuple(rng.randint(0, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(30):
+        x, y = rng.randint(0, size[0]), rng.randint(0, size[1])
+        r = rng.randint(10, size[0] // 4)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def timed(fn, photos):
+    latencies = []
+    results = []
+    for photo in photos:
+        start = time.perf_counter()
+        results.append(fn(photo))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return np.stack(results), {
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+    }
+
+
+def compare(photos, reference, spec, accuracy=None):
+    # Прежний путь и preprocessing.py с каждым фильтром: время, отличие от прежнего пути,
+    # и точность по меткам, если передана функция accuracy(batch).
+    old, old_time = timed(reference, photos)
+    results = {"reference": {**old_time, "accuracy": accuracy(old) if accuracy else None}}
+    for name, resample in FILTERS.items():
+        variant = spec._replace(resample=resample)
+        buf = preprocessing.buffer(variant)
+        new, new_time = timed(lambda p: preprocessing.preprocess(p, variant, buf).copy(), photos)
+        diff = np.abs(old - new)
+        results[name] = {
+            **new_time,
+            "mean_abs_diff": round(float(diff.mean()), 5),
+            "accuracy": accuracy(new) if accuracy else None,
+        }
+    return results
+
+
+def mnist_accuracy(labels):
+    path = os.path.join(ROOT, "mnist_model.tflite")
+    try:
+        import models
+        model = models.TFLiteModel(path)
+    except (ImportError, ValueError) as e:
+        print(f"Модель MNIST недоступна, точность не считается: {e}", file=sys.stderr)
+        return None
+    return lambda batch: round(float((np.argmax(model.predict(batch), axis=1) == labels).mean()), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=1000)
+    parser.add_argument("--size", default="1600x1200")
+    parser.add_argument("--mnist-npz", help="локальный mnist.npz вместо keras.datasets.mnist.load_data()")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+    rng = random.Random(args.seed)
+
+    x_test, y_test = load_mnist(args.mnist_npz)
+    indices = rng.sample(range(len(x_test)), min(args.images, len(x_test)))
+    digits = [mnist_photo(x_test[i], size, rng) for i in indices]
+    labels = np.asarray([y_test[i] for i in indices])
+    animals = [animal_photo(size, rng) for _ in range(args.images)]
+
+    print(json.dumps({
+        "image_size": args.size,
+        "images": len(digits),
+        "mnist": compare(digits, reference_mnist, preprocessing.MNIST, mnist_accuracy(labels)),
+        # размеченных фото кошек и собак и модели в репозитории нет: только время и отличие от прежнего пути
+        "catdog": compare(animals, reference_catdog, preprocessing.CATDOG),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
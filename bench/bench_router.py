@@ -0,0 +1,90 @@
+# Разбор текстовых апдейтов: router.Router против прежней цепочки if/elif
+# с теми же пунктами меню. --extra добавляет в меню пункты, чтобы показать,
+# что время цепочки растет с их числом, а время роутера — нет.
+#
+#   python bench/bench_router.py --updates 200000 --extra 0 50 500
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from router import Router  # noqa: E402
+
+MENU = ["Помощь", "Как меня зовут?", "Инфо", "О боте", "Игра в кубик",
+        "Кто хочет стать миллионером", "Игровой автомат", "Распознавание цифр", "Распознавание животных"]
+COMMANDS = ["start", "help", "cache_on", "cache_off"]
+FREE_TEXT = ["Привет, как дела?", "Расскажи про черные дыры", "Сколько будет 2+2?"]
+
+
+def noop(message):
+    return None
+
+
+def build_router(labels, states):
+    router = Router(get_state=lambda message: states.get(message.from_user.id))
+    router.command(*COMMANDS)(noop)
+    router.state("awaiting_name", "awaiting_age")(noop)
+    for label in labels:
+        router.text(label)(noop)
+    router.default(noop)
+    return router
+
+
+def build_chain(labels, states):
+    # Та же логика, что была в text_event: проверка состояния и перебор пунктов меню.
+    def dispatch(message):
+        text = message.text
+        if text.startswith("/") and text[1:].split("@")[0] in COMMANDS:
+            return noop(message)
+        if states.get(message.from_user.id) == "awaiting_name":
+            return noop(message)
+        for label in labels:
+            if text == label:
+                return noop(message)
+        return noop(message)
+    return dispatch
+
+
+def updates(labels, count, rng):
+    texts = labels + ["/" + c for c in COMMANDS] + FREE_TEXT * 3
+    users = [SimpleNamespace(id=i) for i in range(1000)]
+    return [SimpleNamespace(text=rng.choice(texts), from_user=rng.choice(users)) for _ in range(count)]
+
+
+def measure(dispatch, messages):
+    start = time.perf_counter()
+    for message in messages:
+        dispatch(message)
+    elapsed = time.perf_counter() - start
+    return {"updates_per_s": round(len(messages) / elapsed), "ns_per_update": round(elapsed / len(messages) * 1e9)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=200000)
+    parser.add_argument("--extra", type=int, nargs="+", default=[0, 50, 500])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    states = {i: "awaiting_name" for i in range(0, 1000, 100)}
+
+    results = []
+    for extra in args.extra:
+        labels = MENU + [f"Пункт меню {i}" for i in range(extra)]
+        messages = updates(labels, args.updates, rng)
+        results.append({
+            "menu_items": len(labels),
+            "if_elif": measure(build_chain(labels, states), messages),
+            "router": measure(build_router(labels, states).dispatch, messages),
+        })
+    print(json.dumps({"updates": args.updates, "results": results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict, deque
+
+ROLES = {"u": "user", "a": "assistant"}
+ROLE_CODES = {role: code for code, role in ROLES.items()}
+
+
+def estimate_tokens(text):
+    # Грубая оценка без токенизатора: ~3 символа на токен плюс служебные токены сообщения.
+    return len(text) // 3 + 4
+
+
+class ConversationStore:
+    # История диалогов: у каждого пользователя кольцевой буфер из max_messages
+    # сообщений, в памяти держатся только max_users недавно активных пользователей,
+    # остальные подгружаются из хранилища при следующем обращении.
+    # Над общим хранилищем (shared) история всегда читается из него.
+
+    def __init__(self, storage, system_prompt, namespace="history", max_messages=40,
+                 token_budget=6000, max_users=1000):
+        self.storage = storage
+        self.system_prompt = system_prompt
+        self.namespace = namespace
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _load(self, key):
+        return self._decode(self.storage.get(self.namespace, key, []))
+
+    def _decode(self, raw):
+        turns = deque(maxlen=self.max_messages)
+        for item in raw:
+            if isinstance(item, dict):
+                # старый формат history.json: список {"role", "content"} с системным сообщением
+                if item.get("role") in ROLE_CODES:
+                    turns.append((ROLE_CODES[item["role"]], item.get("content") or ""))
+            else:
+                turns.append((item[0], item[1]))
+        return turns
+
+    def _turns(self, user_id):
+        key = str(user_id)
+        if self.storage.shared:
+            return self._load(key)
+        turns = self._users.get(key)
+        if turns is None:
+            turns = self._load(key)
+            self._users[key] = turns
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return turns
+
+    def append(self, user_id, role, content):
+        if self.storage.shared:
+            def add(raw):
+                turns = self._decode(raw or [])
+                turns.append((ROLE_CODES[role], content))
+                return [list(turn) for turn in turns]
+            self.storage.update(self.namespace, str(user_id), add)
+            return
+        with self._lock:
+            turns = self._turns(user_id)
+            turns.append((ROLE_CODES[role], content))
+            self.storage.put(self.namespace, str(user_id), [list(turn) for turn in turns])
+
+    def messages(self, user_id):
+        # Системное сообщение и самые свежие реплики, уложенные в token_budget.
+        with self._lock:
+            turns = list(self._turns(user_id))
+        budget = self.token_budget - estimate_tokens(self.system_prompt)
+        selected = []
+        for code, content in reversed(turns):
+            budget -= estimate_tokens(content)
+            if budget < 0 and selected:
+                break
+            selected.append({"role": ROLES[code], "content": content})
+        selected.append({"role": "system", "content": self.system_prompt})
+        selected.reverse()
+        return selected
+
+    def clear(self, user_id):
+        with self._lock:
+            self._users.pop(str(user_id), None)
+            self.storage.delete(self.namespace, str(user_id))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users)
@@ -0,0 +1,56 @@
+import os
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 32))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 300))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.5))
+
+
+class JitterRetry(Retry):
+    # Полный джиттер: пауза случайна в [0, backoff], чтобы повторы не шли волной.
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF,
+                   status_forcelist=(429, 500, 502, 503, 504)):
+    retry = JitterRetry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=status_forcelist,
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def timeout(read=None):
+    return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT if read is None else read)
+
+
+session = create_session()
+# 429 от Telegram не повторяется здесь: retry_after соблюдает Outbox, приостанавливая
+# только этот чат, а повтор внутри сессии держал бы поток отправки десятки секунд.
+telegram_session = create_session(status_forcelist=(500, 502, 503, 504))
+
+
+def use_for_telebot(apihelper):
+    # telebot берет apihelper.session во всех потоках вместо собственной сессии.
+    apihelper.session = telegram_session
+    apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
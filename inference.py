@@ -0,0 +1,51 @@
+import logging
+import multiprocessing
+
+import models
+import preprocessing
+
+_models = {}
+
+
+def load_model(path):
+    # Вызывается в процессе пула: модель загружается один раз и живет до конца процесса.
+    model = _models.get(path)
+    if model is None:
+        # параллелизм дают процессы, поэтому каждому интерпретатору по умолчанию один поток
+        models.TFLITE_THREADS = models.TFLITE_THREADS or 1
+        model = models.TFLiteModel(path) if path.endswith(".tflite") else models.KerasModel(path)
+        _models[path] = model
+        logging.info(f"Процесс {multiprocessing.current_process().name} загрузил {path}")
+    return model
+
+
+def load_models(paths):
+    for path in paths:
+        load_model(path)
+
+
+def predict_photos(path, spec, photos):
+    return load_model(path).predict(preprocessing.preprocess_batch(photos, spec))
+
+
+class InferencePool:
+    # Предобработка и инференс в отдельных процессах, чтобы CPU-работа не упиралась в GIL.
+    # Процессы создаются через fork сразу в конструкторе, поэтому пул нужно создать
+    # до запуска других потоков; упавший процесс multiprocessing.Pool заменит сам.
+
+    def __init__(self, processes, timeout=60):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = multiprocessing.get_context("fork").Pool(processes)
+
+    def predict(self, path, spec, photos):
+        # timeout: задача упавшего процесса не вернется никогда
+        return self._pool.apply_async(predict_photos, (path, spec, photos)).get(self.timeout)
+
+    def warm_up(self, paths):
+        # По задаче на процесс; повторная загрузка в одном процессе ничего не стоит.
+        self._pool.map(load_models, [paths] * self.processes, chunksize=1)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
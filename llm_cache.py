@@ -0,0 +1,120 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_prompt(text):
+    text = (text or "").lower().replace("ё", "е")
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def cache_key(prompt, context):
+    raw = json.dumps([normalize_prompt(prompt), context], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, value, created):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+
+    def get(self, key):
+        row = self._conn.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def set(self, key, value, created):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, value, created, created))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def delete(self, key):
+        self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+class ResponseCache:
+    # Кэш ответов LLM на короткие повторяющиеся вопросы с TTL и LRU-вытеснением.
+
+    def __init__(self, backend, ttl=3600, max_prompt_len=200):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_prompt_len = max_prompt_len
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def cacheable(self, prompt):
+        return 0 < len(normalize_prompt(prompt)) <= self.max_prompt_len
+
+    def get(self, key):
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                self.backend.delete(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self.backend.set(key, value, time.time())
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.backend)}
+
+
+def create_cache(kind, path="llm_cache.sqlite3", max_entries=1000, ttl=3600, max_prompt_len=200):
+    if kind == "memory":
+        return ResponseCache(MemoryBackend(max_entries), ttl, max_prompt_len)
+    if kind == "sqlite":
+        return ResponseCache(SQLiteBackend(path, max_entries), ttl, max_prompt_len)
+    return None
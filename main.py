@@ -1,29 +1,91 @@
 import os
 import sys
 import re
+import threading
 import json
 import logging
-import requests
-import gdown
 import numpy as np
-from flask import Flask, request
-from PIL import Image, ImageOps
+from flask import Flask, Response, request
 import telebot
-from tensorflow.keras.models import load_model
-import tensorflow as tf
-from telebot import util
+from telebot import util, apihelper
+import http_client
+import metrics
+from batching import MicroBatcher
+import models
+import inference
+import preprocessing
+import quiz
+from router import Router, command_name
+from prediction_cache import PredictionCache, file_version, image_hash
+from storage import StoredDict, create_storage
+from workers import OrderedWorkerPool
+from polling import BatchPoller
+from outbox import Outbox, OutboxBot
+from conversations import ConversationStore
+import llm_cache
+from streaming import StreamingReply, ThinkFilter, iter_sse_content, strip_think
 
 logging.basicConfig(level=logging.INFO)
+if os.getenv("LOG_TRACE_IDS", "0") == "1":
+    metrics.enable_trace_ids()
 
 API_TOKEN = os.getenv("API_TOKEN")
 if not API_TOKEN:
     sys.exit("Ошибка: API-токен не задан в переменных окружения")
 
-bot = telebot.TeleBot(API_TOKEN)
+SERVER_URL = os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 1000))
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", 1))
+ASYNC_WEBHOOK = bool(SERVER_URL and WEBHOOK_WORKERS > 0)
+
+# batch — getUpdates пачками в пул обработчиков, telebot — прежний infinity_polling
+POLLING_MODE = os.getenv("POLLING_MODE", "batch")
+POLLING_BATCH_SIZE = int(os.getenv("POLLING_BATCH_SIZE", 100))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 30))
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", 16))
+BATCH_POLLING = not SERVER_URL and POLLING_MODE == "batch"
+
+# Предобработка и инференс в пуле процессов; 0 — в потоках этого процесса.
+# Процессы создаются через fork, поэтому пул создается раньше любых потоков.
+INFERENCE_PROCESSES = int(os.getenv("INFERENCE_PROCESSES", 0))
+inference_pool = (inference.InferencePool(INFERENCE_PROCESSES, float(os.getenv("INFERENCE_TIMEOUT", 60)))
+                  if INFERENCE_PROCESSES > 0 else None)
+
+http_client.use_for_telebot(apihelper)
+
+# С пулом обработчиков (асинхронный вебхук, пакетный polling) апдейты
+# обрабатывает он, а не потоки telebot.
+bot = telebot.TeleBot(API_TOKEN, threaded=not (ASYNC_WEBHOOK or BATCH_POLLING))
 app = Flask(__name__)
 
 MAX_LEN = 4096
 
+WEBHOOK_SECONDS = metrics.Histogram("bot_webhook_seconds", "Время ответа маршрута вебхука")
+UPDATE_SECONDS = metrics.Histogram("bot_update_seconds", "Время обработки апдейта", ["kind"])
+TELEGRAM_SECONDS = metrics.Histogram("bot_telegram_request_seconds", "Время до ответа Telegram Bot API", ["method"])
+PHOTO_SECONDS = metrics.Histogram("bot_photo_download_seconds", "Получение фото из Telegram", ["step"])
+PREPROCESS_SECONDS = metrics.Histogram("bot_preprocess_seconds", "Подготовка изображения", ["model"])
+INFERENCE_SECONDS = metrics.Histogram("bot_inference_seconds", "Вызов модели на батч", ["model"])
+INFERENCE_BATCH = metrics.Histogram("bot_inference_batch_size", "Размер батча модели", ["model"],
+                                    buckets=(1, 2, 4, 8, 16, 32, 64))
+LLM_SECONDS = metrics.Histogram("bot_llm_request_seconds", "Запрос к LLM API", ["mode"])
+STORAGE_SECONDS = metrics.Histogram("bot_storage_seconds", "Операции хранилища", ["op"])
+QUEUE_DEPTH = metrics.Gauge("bot_queue_depth", "Задач в очереди", ["queue"])
+IN_FLIGHT = metrics.Gauge("bot_in_flight", "Выполняющихся задач", ["stage"])
+CACHE_HITS = metrics.Counter("bot_cache_hits_total", "Попадания в кэши", ["cache"])
+CACHE_MISSES = metrics.Counter("bot_cache_misses_total", "Промахи кэшей", ["cache"])
+
+def _observe_telegram(response, *args, **kwargs):
+    # Имя метода из URL без токена: /bot<token>/sendMessage, /file/bot<token>/...
+    if "api.telegram.org" not in response.url:
+        return
+    path = response.url.split("api.telegram.org/", 1)[1]
+    method = "download_file" if path.startswith("file/") else path.split("/", 1)[-1].split("?", 1)[0]
+    TELEGRAM_SECONDS.observe(response.elapsed.total_seconds(), method)
+
+http_client.telegram_session.hooks["response"].append(_observe_telegram)
+
 def convert_markdown_to_html(text: str) -> str:
     text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
     text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
@@ -33,11 +95,30 @@ def convert_markdown_to_html(text: str) -> str:
     text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text)
     return text
 
+outbox = Outbox(
+    bot.send_message,
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", 30)),
+    chat_rate=float(os.getenv("SEND_CHAT_RATE", 1)),
+    chat_burst=int(os.getenv("SEND_CHAT_BURST", 3)),
+    merge_window_ms=float(os.getenv("SEND_MERGE_MS", 50)),
+    max_len=MAX_LEN,
+    workers=int(os.getenv("SEND_WORKERS", 4)),
+)
+
+def send_message(chat_id, text, **kwargs):
+    # Отправка в фоне с учетом лимитов Telegram; .result() вернет Message.
+    return outbox.send_message(chat_id, text, **kwargs)
+
+outbox_bot = OutboxBot(outbox, bot)
+
+def send_dice(chat_id, **kwargs):
+    return outbox.call(chat_id, bot.send_dice, chat_id, **kwargs)
+
 def send_long_message(chat_id, text, parse_mode='HTML'):
     try:
         safe_text = convert_markdown_to_html(text or "")
         for part in util.smart_split(safe_text, MAX_LEN):
-            bot.send_message(chat_id, part, parse_mode=parse_mode)
+            send_message(chat_id, part, parse_mode=parse_mode)
     except Exception as e:
         logging.error(f"Ошибка: {e}")
 
@@ -45,82 +126,206 @@ def send_long_message(chat_id, text, parse_mode='HTML'):
 def index():
     return "Бот запущен"
 
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+def update_kind(update):
+    for kind in ("message", "callback_query", "edited_message"):
+        if getattr(update, kind, None):
+            return kind
+    return "other"
+
+def process_update(update):
+    metrics.trace_id.set(str(update.update_id))
+    with UPDATE_SECONDS.time(update_kind(update)):
+        bot.process_new_updates([update])
+
+update_pool = OrderedWorkerPool(process_update, POLLING_WORKERS if BATCH_POLLING else max(WEBHOOK_WORKERS, 1),
+                                WEBHOOK_MAX_PENDING, name="updates" if BATCH_POLLING else "webhook")
+poller = BatchPoller(bot, update_pool, update_chat_id, POLLING_BATCH_SIZE, POLLING_TIMEOUT,
+                     queue_timeout=WEBHOOK_QUEUE_TIMEOUT)
+QUEUE_DEPTH.set_function(update_pool.pending, "webhook")
+QUEUE_DEPTH.set_function(outbox.pending, "outbox")
+IN_FLIGHT.set_function(update_pool.in_flight, "webhook")
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/ready')
+def ready():
+    if ML_WARMUP and not models_ready.is_set():
+        return "Модели загружаются", 503
+    return "OK"
+
+@app.route('/llm-cache')
+def llm_cache_stats():
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_cache.stats()}
+
 @app.route(f'/{API_TOKEN}', methods=['POST'])
 def webhook():
+    with WEBHOOK_SECONDS.time():
+        return _webhook()
+
+def _webhook():
     try:
         json_str = request.get_data(as_text=True)
         update = telebot.types.Update.de_json(json_str)
         if update:
-            bot.process_new_updates([update])
+            if not ASYNC_WEBHOOK:
+                process_update(update)
+            elif not update_pool.submit(update_chat_id(update), update, WEBHOOK_QUEUE_TIMEOUT):
+                # Telegram повторит доставку позже
+                app.logger.warning("Очередь вебхука переполнена")
+                return '', 503
     except Exception as e:
         app.logger.exception(f"Webhook error: {str(e)}")
     return '', 200
 
-def load_photo(message, name):
+def load_photo(message):
     photo = message.photo[-1]
-    file_info = bot.get_file(photo.file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    save_path = name
-    with open(save_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
+    with PHOTO_SECONDS.time("get_file"):
+        file_info = bot.get_file(photo.file_id)
+    with PHOTO_SECONDS.time("download_file"):
+        return bot.download_file(file_info.file_path)
 
-history_file = "history.json"
-history = {}
 
-if os.path.exists(history_file):
-    try:
-        with open(history_file, "r", encoding='utf-8') as f:
-            history = json.load(f)
-    except Exception:
-        history = {}
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot.sqlite3")
+STORAGE_FLUSH_MS = int(os.getenv("STORAGE_FLUSH_MS", 200))
+# redis://host:6379/0 — общее состояние для нескольких процессов бота
+STORAGE_URL = os.getenv("STORAGE_URL", STORAGE_PATH)
+storage = create_storage(STORAGE_URL, STORAGE_FLUSH_MS,
+                         on_flush=lambda seconds, records: STORAGE_SECONDS.observe(seconds, "flush"))
+QUEUE_DEPTH.set_function(storage.pending, "storage")
 
-def save_history():
-    try:
-        with open(history_file, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.error(f"Ошибка сохранения истории: %s", e)
+# Следующий шаг диалога хранится в storage, а не в памяти процесса,
+# поэтому ответ может обработать любой воркер.
+STEP_HANDLERS = {}
+
+def step_handler(fn):
+    STEP_HANDLERS[fn.__name__] = fn
+    return fn
+
+def register_next_step(message, handler):
+    storage.put("steps", str(message.chat.id), handler.__name__)
+
+def _has_next_step(message):
+    return storage.get("steps", str(message.chat.id)) is not None
+
+@bot.message_handler(func=_has_next_step, content_types=util.content_type_media)
+def run_next_step(message):
+    name = storage.pop("steps", str(message.chat.id))
+    if name in STEP_HANDLERS:
+        STEP_HANDLERS[name](message)
+
+history_file = "history.json"
+storage.import_json("history", history_file)
+history = ConversationStore(
+    storage,
+    "Ты — ответственный наставник.",
+    max_messages=int(os.getenv("CHAT_HISTORY_MESSAGES", 40)),
+    token_budget=int(os.getenv("CHAT_TOKEN_BUDGET", 6000)),
+    max_users=int(os.getenv("CHAT_USERS_IN_MEMORY", 1000)),
+)
 
 AI_KEY = os.getenv('AI_KEY')
 if not AI_KEY:
     logging.warning("API_KEY не задан: чат-модель будет недоступна")
 
-def chat(user_id, text):
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+LLM_STREAM_EDIT_INTERVAL = float(os.getenv("LLM_STREAM_EDIT_INTERVAL", 1.0))
+
+LLM_MODEL = "deepseek-ai/DeepSeek-R1-0528"
+LLM_URL = os.getenv("LLM_URL", "https://api.intelligence.io.solutions/api/v1/chat/completions")
+LLM_CACHE_CONTEXT_TURNS = int(os.getenv("LLM_CACHE_CONTEXT_TURNS", 2))
+response_cache = llm_cache.create_cache(
+    os.getenv("LLM_CACHE", "off"),
+    path=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"),
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("LLM_CACHE_TTL", 3600)),
+    max_prompt_len=int(os.getenv("LLM_CACHE_MAX_PROMPT", 200)),
+)
+
+if response_cache is not None:
+    CACHE_HITS.set_function(lambda: response_cache.hits, "llm")
+    CACHE_MISSES.set_function(lambda: response_cache.misses, "llm")
+
+def response_cache_key(user_id, text, messages):
+    if response_cache is None or not response_cache.cacheable(text):
+        return None
+    if not db.get(str(user_id), {}).get("llm_cache", True):
+        return None
+    # ключ зависит от модели, системного промпта и последних реплик перед вопросом
+    context = messages[-1 - LLM_CACHE_CONTEXT_TURNS:-1] if LLM_CACHE_CONTEXT_TURNS else []
+    return llm_cache.cache_key(text, [LLM_MODEL, messages[0], context])
+
+def stream_completion(url, headers, data, reply):
+    think = ThinkFilter()
+    parts = []
+    with LLM_SECONDS.time("stream"), IN_FLIGHT.track("llm"), \
+            http_client.session.post(url, headers=headers, json={**data, "stream": True},
+                                  timeout=http_client.timeout(), stream=True) as response:
+        if response.status_code != 200:
+            return response.json()
+        for chunk in iter_sse_content(response):
+            parts.append(chunk)
+            reset, visible = think.feed(chunk)
+            if reset:
+                reply.reset()
+            if visible:
+                reply.feed(visible)
+    visible = think.finish()
+    if visible:
+        reply.feed(visible)
+    return {"choices": [{"message": {"content": "".join(parts)}}]}
+
+def chat(user_id, text, reply=None):
     try:
-        if str(user_id) not in history:
-            history[str(user_id)] = [
-                {"role": "system", "content": "Ты — ответственный наставник."}
-            ]
-
-        history[str(user_id)].append({"role": "user", "content": text})
-
-        if len(history[str(user_id)]) > 16:
-            history[str(user_id)] = [history[str(user_id)][0]] + history[str(user_id)][-15:]
-
-        url = "https://api.intelligence.io.solutions/api/v1/chat/completions"
+        history.append(user_id, "user", text)
+        messages = history.messages(user_id)
+
+        cache_key = response_cache_key(user_id, text, messages)
+        cached = response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            history.append(user_id, "assistant", cached)
+            if reply is not None:
+                reply.feed(cached)
+            return cached
+
+        url = LLM_URL
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {AI_KEY}" if AI_KEY else ""
         }
         data = {
-            "model": "deepseek-ai/DeepSeek-R1-0528",
-            "messages": history[str(user_id)]
+            "model": LLM_MODEL,
+            "messages": messages
         }
 
-        response = requests.post(url, headers=headers, json=data, timeout=300)
-        data = response.json()
+        if reply is not None:
+            data = stream_completion(url, headers, data, reply)
+        else:
+            with LLM_SECONDS.time("blocking"), IN_FLIGHT.track("llm"):
+                response = http_client.session.post(url, headers=headers, json=data, timeout=http_client.timeout())
+            data = response.json()
 
         if isinstance(data, dict) and data.get('choices'):
             content = data['choices'][0]['message']['content']
-            history[str(user_id)].append({"role": "assistant", "content": content})
-
-            if len(history[str(user_id)]) > 16:
-                history[str(user_id)] = [history[str(user_id)][0]] + history[str(user_id)][-15:]
-
-            save_history()
-
-            if '</think>' in content:
-                return content.split('</think>', 1)[1]
+            content = strip_think(content)
+            # рассуждения не сохраняем: они только раздувают следующие запросы
+            with STORAGE_SECONDS.time("save_history"):
+                history.append(user_id, "assistant", content)
+            if cache_key:
+                response_cache.set(cache_key, content)
             return content
         else:
             logging.error(f"Ошибка API: {json.dumps(data, ensure_ascii=False)}")
@@ -129,325 +334,402 @@ def chat(user_id, text):
         send_long_message(user_id, "Ошибка при запросе: {e}, повторите попытку позже")
 
 def load_db():
-    try:
-        with open('db.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+    storage.import_json("users", "db.json")
+    return StoredDict(storage, "users")
 
-def save_db(data):
-    with open('db.json', 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def save_db(user_id):
+    with STORAGE_SECONDS.time("save_db"):
+        db.save(user_id)
 
 db = load_db()
+def update_user(user_id, **changes):
+    with STORAGE_SECONDS.time("save_db"):
+        return db.modify(user_id, lambda user: {**user, **changes})
+
+def add_money(user_id, amount):
+    with STORAGE_SECONDS.time("save_db"):
+        user = db.modify(user_id, lambda user: {**user, "money": user["money"] + amount})
+    return user["money"]
+
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", 16))
+INFERENCE_BATCH_WAIT_MS = float(os.getenv("INFERENCE_BATCH_WAIT_MS", 5))
 
 TFLITE_PATH = "cat_dog_model.tflite"
 TFLITE_URL = os.getenv("CAT_DOGS_TFLITE_URL")
-_interpreter = None
-_input_details = None
-_output_details = None
+_catdog_model = None
 
-def ensure_catdog_tflite():
-    global _interpreter, _input_details, _output_details
-    if _interpreter is None:
+_catdog_download_lock = threading.Lock()
+
+
+def catdog_model_path():
+    # Вызывается из нескольких потоков батчера: скачивает только первый, остальные ждут.
+    # Файл появляется под своим именем только целиком, поэтому проверка без блокировки безопасна.
+    if os.path.exists(TFLITE_PATH):
+        return TFLITE_PATH
+    with _catdog_download_lock:
         if not os.path.exists(TFLITE_PATH):
             if not TFLITE_URL:
                 raise RuntimeError("CAT_DOGS_TFLITE_URL не задан, а локальной модели нет")
-            gdown.download(TFLITE_URL, TFLITE_PATH, quiet=False)
+            import gdown
+            partial = TFLITE_PATH + ".part"
+            gdown.download(TFLITE_URL, partial, quiet=False)
+            os.replace(partial, TFLITE_PATH)
+    return TFLITE_PATH
 
-        _interpreter = tf.lite.Interpreter(model_path=TFLITE_PATH)
-        _interpreter.allocate_tensors()
-        _input_details = _interpreter.get_input_details()
-        _output_details = _interpreter.get_output_details()
-    return _interpreter, _input_details, _output_details
+def ensure_catdog_tflite():
+    global _catdog_model
+    if _catdog_model is None:
+        _catdog_model = models.TFLiteModel(catdog_model_path())
+    return _catdog_model
 
-def cat_dog(photo):
-    try:
-        interpreter, input_details, output_details = ensure_catdog_tflite()
 
-        image = Image.open(photo).convert("RGB")
-        image = ImageOps.fit(image, (150, 150), method=Image.Resampling.LANCZOS)
-        x = (np.asarray(image).astype(np.float32) / 255.0)[None, ...]
+def _predict_catdog_batch(images):
+    # С пулом процессов в батче не массивы, а байты фото: предобработка тоже идет там.
+    INFERENCE_BATCH.observe(len(images), "catdog")
+    if inference_pool is not None:
+        path = catdog_model_path()
+        with INFERENCE_SECONDS.time("catdog"):
+            return list(inference_pool.predict(path, preprocessing.CATDOG, images))
+    model = ensure_catdog_tflite()
+    with INFERENCE_SECONDS.time("catdog"):
+        return list(model.predict(np.stack(images)))
 
-        interpreter.set_tensor(input_details[0]['index'], x)
-        interpreter.invoke()
-        pred = interpreter.get_tensor(output_details[0]['index'])
 
-        if pred.ndim == 2 and pred.shape[1] == 1:
-            confidence = float(pred[0][0])
-        elif pred.ndim == 1:
-            confidence = float(pred[0])
-        else:
-            confidence = float(np.ravel(pred)[0])
+_catdog_batcher = MicroBatcher(_predict_catdog_batch, INFERENCE_BATCH_SIZE, INFERENCE_BATCH_WAIT_MS,
+                               name="catdog-batcher", workers=max(INFERENCE_PROCESSES, 1))
+QUEUE_DEPTH.set_function(_catdog_batcher.qsize, "catdog")
+
+
+def _classify_cat_dog(photo):
+    if inference_pool is not None:
+        return float(_catdog_batcher.predict(photo)[0])
+    with PREPROCESS_SECONDS.time("catdog"):
+        x = preprocessing.preprocess(photo, preprocessing.CATDOG, preprocessing.buffer(preprocessing.CATDOG))
+    return float(_catdog_batcher.predict(x)[0])
 
-        return (f"На изображении собака (точность: {confidence:.2f})"
-                if confidence >= 0.5 else
-                f"На изображении кот (точность: {1 - confidence:.2f})")
+def _format_cat_dog(confidence):
+    return (f"На изображении собака (точность: {confidence:.2f})"
+            if confidence >= 0.5 else
+            f"На изображении кот (точность: {1 - confidence:.2f})")
+
+def cat_dog(photo):
+    try:
+        return _format_cat_dog(_classify_cat_dog(photo))
     except Exception as e:
         return f"Ошибка при распознавании: {e}"
 
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", 10000))
+prediction_cache = PredictionCache(STORAGE_PATH, PREDICTION_CACHE_SIZE) if PREDICTION_CACHE_SIZE > 0 else None
+if prediction_cache is not None:
+    CACHE_HITS.set_function(lambda: prediction_cache.hits, "prediction")
+    CACHE_MISSES.set_function(lambda: prediction_cache.misses, "prediction")
+
+def cached_prediction(message, model, model_path, classify):
+    # Сначала file_unique_id (без скачивания), затем sha256 скачанного файла.
+    if prediction_cache is None or not os.path.exists(model_path):
+        return classify(load_photo(message))
+    version = file_version(model_path)
+    file_key = f"file:{message.photo[-1].file_unique_id}"
+    result = prediction_cache.get(model, file_key, version)
+    if result is not None:
+        return result
+    photo = load_photo(message)
+    image_key = f"sha256:{image_hash(photo)}"
+    result = prediction_cache.get(model, image_key, version)
+    if result is None:
+        result = classify(photo)
+    prediction_cache.set(model, [file_key, image_key], version, result)
+    return result
+
+@step_handler
 def ident_number(message):
-    load_photo(message, "Number.jpg")
-    answer_number = number_identification("Number.jpg")
-    bot.send_message(message.chat.id, f"Цифра на фото: {answer_number}")
+    try:
+        answer_number = cached_prediction(message, "mnist", mnist_model_path(), _classify_number)
+    except Exception as e:
+        answer_number = f"Ошибка распознавания цифры: {e}"
+    send_message(message.chat.id, f"Цифра на фото: {answer_number}")
 
+@step_handler
 def ident_cat_dog(message):
-    load_photo(message, "cat_dog.jpg")
-    answer = cat_dog("cat_dog.jpg")
-    bot.send_message(message.chat.id, answer)
+    try:
+        answer = _format_cat_dog(cached_prediction(message, "catdog", TFLITE_PATH, _classify_cat_dog))
+    except Exception as e:
+        answer = f"Ошибка при распознавании: {e}"
+    send_message(message.chat.id, answer)
 
 MNIST_PATH = "mnist_model.h5"
+MNIST_TFLITE_PATH = "mnist_model.tflite"
 _mnist_model = None
 
 
+def mnist_model_path():
+    # сконвертированная модель: python models.py mnist_model.h5 mnist_model.tflite
+    # .tflite берется, только если он сконвертирован из текущего .h5
+    if not os.path.exists(MNIST_TFLITE_PATH):
+        return MNIST_PATH
+    if not os.path.exists(MNIST_PATH) or models.converted_from(MNIST_TFLITE_PATH, MNIST_PATH):
+        return MNIST_TFLITE_PATH
+    if not _mnist_stale_logged.is_set():
+        _mnist_stale_logged.set()
+        logging.warning(f"{MNIST_TFLITE_PATH} сконвертирован не из текущего {MNIST_PATH}, "
+                        f"используется {MNIST_PATH}")
+    return MNIST_PATH
+
+_mnist_stale_logged = threading.Event()
+
+
 def ensure_mnist():
     global _mnist_model
     if _mnist_model is None:
-        if not os.path.exists(MNIST_PATH):
+        path = mnist_model_path()
+        if not os.path.exists(path):
             raise RuntimeError("MNIST модель не найдена: mnist_model.h5")
-        _mnist_model = load_model(MNIST_PATH, compile=False)
+        _mnist_model = models.TFLiteModel(path) if path.endswith(".tflite") else models.KerasModel(path)
+        logging.info(f"MNIST модель загружена из {path}")
     return _mnist_model
 
 
-def number_identification(photo):
-    try:
+def _predict_mnist_batch(images):
+    INFERENCE_BATCH.observe(len(images), "mnist")
+    if inference_pool is not None:
+        path = mnist_model_path()
+        with INFERENCE_SECONDS.time("mnist"):
+            pred = inference_pool.predict(path, preprocessing.MNIST, images)
+    else:
         model = ensure_mnist()
-        image = Image.open(photo).convert("L")
-        image = ImageOps.invert(image)
-        image = ImageOps.fit(image, (28, 28), method=Image.Resampling.LANCZOS)
-        x = (np.asarray(image).astype(np.float32) / 255.0).reshape(1, 28, 28, 1)
-        pred = model.predict(x, verbose=0)
-        return str(int(np.argmax(pred)))
-    except Exception as e:
-        return f"Ошибка распознавания цифры: {e}"
-
-@bot.message_handler(commands=['start'])
-def start(message):
-    user_id =str(message.from_user.id)
+        with INFERENCE_SECONDS.time("mnist"):
+            pred = model.predict(np.stack(images))
+    return [int(np.argmax(p)) for p in pred]
 
-    if user_id not in db:
-        db[user_id] = {"name": 'awaiting_name', "age": None, "money": 10000, "state": "awaiting_name"}
-        save_db(db)
-        bot.send_message(message.chat.id, "Привет! Как тебя зовут?")
-        return 0
 
-    db[user_id]["money"] = 10000
+_mnist_batcher = MicroBatcher(_predict_mnist_batch, INFERENCE_BATCH_SIZE, INFERENCE_BATCH_WAIT_MS,
+                              name="mnist-batcher", workers=max(INFERENCE_PROCESSES, 1))
+QUEUE_DEPTH.set_function(_mnist_batcher.qsize, "mnist")
 
-    keyboardReply = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
 
-    helpButton = telebot.types.KeyboardButton("Помощь")
-    infoButton = telebot.types.KeyboardButton("Инфо")
-    aboutButton = telebot.types.KeyboardButton("О боте")
-    linkButton = telebot.types.KeyboardButton("Ссылка на чат")
-    slowMachineButton = telebot.types.KeyboardButton("Игровой автомат")
-    diceButton = telebot.types.KeyboardButton("Игра в кубик")
-    gameButton = telebot.types.KeyboardButton("Кто хочет стать миллионером")
-    numberButton = telebot.types.KeyboardButton("Распознавание цифр")
-    animalButton = telebot.types.KeyboardButton("Распознавание животных")
+def _classify_number(photo):
+    if inference_pool is not None:
+        return _mnist_batcher.predict(photo)
+    with PREPROCESS_SECONDS.time("mnist"):
+        x = preprocessing.preprocess(photo, preprocessing.MNIST, preprocessing.buffer(preprocessing.MNIST))
+    return _mnist_batcher.predict(x)
 
-    keyboardReply.add(helpButton, infoButton, aboutButton, linkButton, slowMachineButton, diceButton, gameButton, numberButton, animalButton)
 
-    bot.send_message(message.chat.id, "Привет, я бот с интегрированной моделью DeepSeek! Задай мне вопрос", reply_markup=keyboardReply)
-
-@bot.message_handler(content_types=['photos'])
-def handle_photo(message):
+def number_identification(photo):
     try:
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        temp_path = "temp.jpg"
-        with open(temp_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
-        result = cat_dog(temp_path)
+        return str(_classify_number(photo))
     except Exception as e:
-        bot.send_message(message.chat.id, f"Ошибка обработки фото: {e}")
+        return f"Ошибка распознавания цифры: {e}"
 
-@bot.message_handler(commands=['help'])
-def help(message):
-    bot.send_message(message.chat.id, "Инструкция по использованию ботом")
+ML_WARMUP = os.getenv("ML_WARMUP", "0") == "1"
+models_ready = threading.Event()
 
-@bot.message_handler(content_types=['text'])
-def text_event(message):
+def warm_up_models():
+    # Загрузка идет через батчеры, чтобы модели создавались в их рабочих потоках.
     try:
-        user_id = str(message.from_user.id)
-        text = message.text
-        if "awaiting_name" == db.get(user_id, {}).get("state"):
-            name = message.text.strip()
-            db[user_id]["name"] = name
-            db[user_id]["state"] = None
-            save_db(db)
-            bot.send_message(message.chat.id, f"Приятно познакомиться, {name}")
-            bot.send_message(message.chat.id, "Сколько тебе лет?")
+        if inference_pool is not None:
+            paths = [mnist_model_path()]
+            if os.path.exists(TFLITE_PATH) or TFLITE_URL:
+                paths.append(catdog_model_path())
+            inference_pool.warm_up(paths)
+            models_ready.set()
+            logging.info("Модели загружены в процессы пула")
             return
-        elif db.get(user_id, {}).get("state") == "awaiting_name":
-            try:
-                age = int(message.text.strip())
-                db[user_id]["age"] = age
-                db[user_id]["state"] = None
-                save_db(db)
-                start(message)
-                return
-            except:
-                bot.send_message(message.chat.id, "Ты ввел значение возраста некорректно")
-                return
-
-        if message.text == "Помощь":
-            bot.send_message(message.chat.id, "Привет! Чем я могу помочь?")
-        elif message.text == "Как меня зовут?":
-            user_name = db[user_id]["name"]
-            bot.send_message(message.chat.id, f"Тебя зовут {user_name}")
-        elif message.text == "Инфо":
-            bot.send_message(message.chat.id, "Админ: @dvchkliana")
-        elif message.text == "О боте":
-            bot.send_message(message.chat.id, "Бот для общения")
-        elif message.text == "Игра в кубик":
-            inlineKeyboard = telebot.types.InlineKeyboardMarkup(row_width=3)
-
-            btn1 = telebot.types.InlineKeyboardButton("1", callback_data='1')
-            btn2 = telebot.types.InlineKeyboardButton("2", callback_data='2')
-            btn3 = telebot.types.InlineKeyboardButton("3", callback_data='3')
-            btn4 = telebot.types.InlineKeyboardButton("4", callback_data='4')
-            btn5 = telebot.types.InlineKeyboardButton("5", callback_data='5')
-            btn6 = telebot.types.InlineKeyboardButton("6", callback_data='6')
-
-            inlineKeyboard.add(btn1, btn2, btn3, btn4, btn5, btn6)
-
-            bot.send_message(message.chat.id, "Угадай число на кубике", reply_markup=inlineKeyboard)
-
-        elif message.text == "Кто хочет стать миллионером":
-            if db[user_id]["money"] >= 10000:
-                inlineKeyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
-
-                bttn1 = telebot.types.InlineKeyboardButton("170", callback_data='170')
-                bttn2 = telebot.types.InlineKeyboardButton("130", callback_data='130')
-                bttn3 = telebot.types.InlineKeyboardButton("169", callback_data='169')
-                bttn4 = telebot.types.InlineKeyboardButton("26", callback_data='26')
-
-                inlineKeyboard.add(bttn1, bttn2, bttn3, bttn4)
-
-                bot.send_message(message.chat.id, "Сколько будет 13 в квадрате?", reply_markup=inlineKeyboard)
-        elif message.text == "Игровой автомат":
-            if db[user_id]["money"] >= 10000:
-                value = bot.send_dice(message.chat.id, emoji='🎰').dice.value
-
-                if value in (1, 22, 43):
-                    db[user_id]["money"] += 2000
-                    bot.send_message(message.chat.id, f"Победа! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-                elif value in (16, 32, 48):
-                    db[user_id]["money"] += 1000
-                    bot.send_message(message.chat.id, f"Тебе везет! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-                elif value == 64:
-                    db[user_id]["money"] += 4000
-                    bot.send_message(message.chat.id, f"Джекпот! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-                else:
-                    db[user_id]["money"] -= 1000
-                    bot.send_message(message.chat.id, f"Ты проиграл! Ты потерял 1000. Твой баланс: {db[user_id]['money']}")
-            else:
-                    bot.send_message(message.chat.id, f"У тебя недостаточно средств на балансе.")
-        elif text == "Распознавание цифр":
-            send1 = bot.send_message(message.chat.id, "Загрузите изображение цифры")
-            bot.register_next_step_handler(send1, ident_number)
-        elif text == "Распознавание животных":
-            send2 = bot.send_message(message.chat.id, "Загрузите изображение кошки или собаки")
-            bot.register_next_step_handler(send2, ident_cat_dog)
-        else:
-            msg = bot.send_message(message.chat.id, "Думаю над ответом...")
-            try:
-                answer = chat(message.chat.id, message.text)
-                send_long_message(message.chat.id, answer)
-            finally:
-                try:
-                    bot.delete_message(message.chat.id, msg.message_id)
-                except Exception:
-                    pass
+        _mnist_batcher.predict(np.zeros(preprocessing.shape(preprocessing.MNIST), dtype=np.float32))
+        if os.path.exists(TFLITE_PATH) or TFLITE_URL:
+            _catdog_batcher.predict(np.zeros(preprocessing.shape(preprocessing.CATDOG), dtype=np.float32))
+        models_ready.set()
+        logging.info("Модели загружены")
     except Exception as e:
-        bot.send_message(message.chat.id, f"Error: {e}")
-@bot.callback_query_handler(func=lambda call: call.data in ('170', '130', '169', '26'))
-def game_callback(call):
-    user_id = str(call.from_user.id)
-    value = call.data
-    if str(value) == '169':
-        inlineKeyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
-
-        btt1 = telebot.types.InlineKeyboardButton("Кристаллизация", callback_data='a')
-        btt2 = telebot.types.InlineKeyboardButton("Испарение", callback_data='b')
-        btt3 = telebot.types.InlineKeyboardButton("Плавление", callback_data='c')
-        btt4 = telebot.types.InlineKeyboardButton("Конвекция", callback_data='d')
-
-        inlineKeyboard.add(btt1, btt2, btt3, btt4)
-        db[user_id]["money"] += 2000
-        bot.send_message(call.message.chat.id, f"Ты угадал! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-        bot.send_message(call.message.chat.id, "Как называется переход тела из жидкого состояния в твердое?", reply_markup=inlineKeyboard)
+        logging.error(f"Ошибка прогрева моделей: {e}")
 
-    else:
-        bot.send_message(call.message.chat.id, "Попробуй еще раз")
+if ML_WARMUP:
+    threading.Thread(target=warm_up_models, name="warmup", daemon=True).start()
 
-@bot.callback_query_handler(func=lambda call: call.data in ('a', 'b', 'c', 'd'))
-def g_callback(call):
-    user_id = str(call.from_user.id)
-    value = call.data
-    if str(value) == 'a':
-        inlineKeyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
+QUIZ_PATH = os.getenv("QUIZ_PATH", "quiz.json")
+millionaire = quiz.Quiz.load(QUIZ_PATH)
 
-        btt1 = telebot.types.InlineKeyboardButton("5", callback_data='1a')
-        btt2 = telebot.types.InlineKeyboardButton("1", callback_data='2b')
-        btt3 = telebot.types.InlineKeyboardButton("3", callback_data='3c')
-        btt4 = telebot.types.InlineKeyboardButton("2", callback_data='4d')
+def user_state(message):
+    return db.get(str(message.from_user.id), {}).get("state")
 
-        inlineKeyboard.add(btt1, btt2, btt3, btt4)
-        db[user_id]["money"] += 2000
-        bot.send_message(call.message.chat.id, f"Ты угадал! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-        bot.send_message(call.message.chat.id, "Сколько атомов водорода в воде?", reply_markup=inlineKeyboard)
+router = Router(get_state=user_state)
 
-    else:
-        bot.send_message(call.message.chat.id, "Попробуй еще раз")
+MENU = ("Помощь", "Инфо", "О боте", "Ссылка на чат", "Игровой автомат", "Игра в кубик",
+        "Кто хочет стать миллионером", "Распознавание цифр", "Распознавание животных")
 
-@bot.callback_query_handler(func=lambda call: call.data in ('1a', '2b', '3c', '4d'))
-def a_callback(call):
-    user_id = str(call.from_user.id)
-    value = call.data
-    if str(value) == '4d':
-        inlineKeyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
+def build_markup(markup, buttons):
+    # Разметка сериализуется один раз; telebot отправляет строку reply_markup как есть.
+    markup.add(*buttons)
+    return markup.to_json()
 
-        b1 = telebot.types.InlineKeyboardButton("Республика Татарстан", callback_data='r')
-        b2 = telebot.types.InlineKeyboardButton("Республика Саха", callback_data='s')
-        b3 = telebot.types.InlineKeyboardButton("Московская область", callback_data='m')
-        b4 = telebot.types.InlineKeyboardButton("Красноярский край", callback_data='k')
+MAIN_KEYBOARD = build_markup(telebot.types.ReplyKeyboardMarkup(resize_keyboard=True),
+                             [telebot.types.KeyboardButton(label) for label in MENU])
+DICE_KEYBOARD = build_markup(telebot.types.InlineKeyboardMarkup(row_width=3),
+                             [telebot.types.InlineKeyboardButton(str(i), callback_data=str(i)) for i in range(1, 7)])
 
-        inlineKeyboard.add(b1, b2, b3, b4)
-        db[user_id]["money"] += 2000
-        bot.send_message(call.message.chat.id, f"Ты угадал! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-        bot.send_message(call.message.chat.id, "Какой самый большой субъект РФ?", reply_markup=inlineKeyboard)
+@router.command("start")
+def start(message):
+    user_id =str(message.from_user.id)
 
+    if user_id not in db:
+        db[user_id] = {"name": 'awaiting_name', "age": None, "money": 10000, "state": "awaiting_name"}
+        save_db(user_id)
+        send_message(message.chat.id, "Привет! Как тебя зовут?")
+        return 0
+
+    update_user(user_id, money=10000)
+    send_message(message.chat.id, "Привет, я бот с интегрированной моделью DeepSeek! Задай мне вопрос", reply_markup=MAIN_KEYBOARD)
+
+@bot.message_handler(content_types=['photos'])
+def handle_photo(message):
+    try:
+        result = cat_dog(load_photo(message))
+    except Exception as e:
+        send_message(message.chat.id, f"Ошибка обработки фото: {e}")
+
+@router.command("cache_on", "cache_off")
+def cache_settings(message):
+    user_id = str(message.from_user.id)
+    if user_id not in db:
+        return start(message)
+    user = update_user(user_id, llm_cache=command_name(message.text) == "cache_on")
+    status = "включено" if user["llm_cache"] else "выключено"
+    send_message(message.chat.id, f"Кэширование ответов {status}")
+
+@router.command("help")
+def help(message):
+    send_message(message.chat.id, "Инструкция по использованию ботом")
+
+@router.state("awaiting_name")
+def save_name(message):
+    name = message.text.strip()
+    update_user(str(message.from_user.id), name=name, state="awaiting_age")
+    send_message(message.chat.id, f"Приятно познакомиться, {name}")
+    send_message(message.chat.id, "Сколько тебе лет?")
+
+@router.state("awaiting_age")
+def save_age(message):
+    try:
+        age = int(message.text.strip())
+    except ValueError:
+        send_message(message.chat.id, "Ты ввел значение возраста некорректно")
+        return
+    update_user(str(message.from_user.id), age=age, state=None)
+    start(message)
+
+@router.text("Помощь")
+def menu_help(message):
+    send_message(message.chat.id, "Привет! Чем я могу помочь?")
+
+@router.text("Как меня зовут?")
+def whats_my_name(message):
+    user_name = db[str(message.from_user.id)]["name"]
+    send_message(message.chat.id, f"Тебя зовут {user_name}")
+
+@router.text("Инфо")
+def info(message):
+    send_message(message.chat.id, "Админ: @dvchkliana")
+
+@router.text("О боте")
+def about(message):
+    send_message(message.chat.id, "Бот для общения")
+
+@router.text("Игра в кубик")
+def dice_game(message):
+    send_message(message.chat.id, "Угадай число на кубике", reply_markup=DICE_KEYBOARD)
+
+@router.text("Кто хочет стать миллионером")
+def millionaire_game(message):
+    if db[str(message.from_user.id)]["money"] >= millionaire.min_balance:
+        question = millionaire.first()
+        send_message(message.chat.id, question.text, reply_markup=question.keyboard)
+
+@router.text("Игровой автомат")
+def slot_machine(message):
+    user_id = str(message.from_user.id)
+    if db[user_id]["money"] < 10000:
+        send_message(message.chat.id, f"У тебя недостаточно средств на балансе.")
+        return
+    value = send_dice(message.chat.id, emoji='🎰').result().dice.value
+
+    if value in (1, 22, 43):
+        balance = add_money(user_id, 2000)
+        send_message(message.chat.id, f"Победа! Твой выигрыш составил 2000. Твой баланс: {balance}")
+    elif value in (16, 32, 48):
+        balance = add_money(user_id, 1000)
+        send_message(message.chat.id, f"Тебе везет! Твой выигрыш составил 2000. Твой баланс: {balance}")
+    elif value == 64:
+        balance = add_money(user_id, 4000)
+        send_message(message.chat.id, f"Джекпот! Твой выигрыш составил 2000. Твой баланс: {balance}")
     else:
-        bot.send_message(call.message.chat.id, "Попробуй еще раз!")
-
-@bot.callback_query_handler(func=lambda call: call.data in ('r', 's', 'm', 'k'))
-def m_callback(call):
-    user_id = str(call.from_user.id)
-    value = call.data
-    if str(value) == 's':
-        db[user_id]["money"] += 2000
-        bot.send_message(call.message.chat.id, f"Ты победил! Твой выигрыш составил 2000. Твой баланс: {db[user_id]['money']}")
-    else:
-        bot.send_message(call.message.chat.id, "Ты проиграл! Попробуй еще раз.")
+        balance = add_money(user_id, -1000)
+        send_message(message.chat.id, f"Ты проиграл! Ты потерял 1000. Твой баланс: {balance}")
+
+@router.text("Распознавание цифр")
+def digit_recognition(message):
+    send1 = send_message(message.chat.id, "Загрузите изображение цифры").result()
+    register_next_step(send1, ident_number)
+
+@router.text("Распознавание животных")
+def animal_recognition(message):
+    send2 = send_message(message.chat.id, "Загрузите изображение кошки или собаки").result()
+    register_next_step(send2, ident_cat_dog)
+
+@router.default
+def ask_llm(message):
+    msg = send_message(message.chat.id, "Думаю над ответом...").result()
+    if LLM_STREAMING:
+        reply = StreamingReply(outbox_bot, message.chat.id, msg.message_id, convert_markdown_to_html,
+                               MAX_LEN, LLM_STREAM_EDIT_INTERVAL)
+        if chat(message.chat.id, message.text, reply) is None:
+            reply.fail()
+        else:
+            reply.finish()
+        return
+    try:
+        answer = chat(message.chat.id, message.text)
+        send_long_message(message.chat.id, answer)
+    finally:
+        outbox.call(message.chat.id, bot.delete_message, message.chat.id, msg.message_id)
+
+@bot.message_handler(content_types=['text'])
+def text_event(message):
+    try:
+        router.dispatch(message)
+    except Exception as e:
+        send_message(message.chat.id, f"Error: {e}")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(quiz.PREFIX))
+def quiz_callback(call):
+    parsed = millionaire.parse(call.data)
+    if parsed is None:
+        return
+    question, correct = parsed
+    if not correct:
+        send_message(call.message.chat.id, question.wrong)
+        return
+    balance = add_money(str(call.from_user.id), question.reward)
+    send_message(call.message.chat.id, question.correct.format(reward=question.reward, balance=balance))
+    if question.next is not None:
+        following = millionaire.questions[question.next]
+        send_message(call.message.chat.id, following.text, reply_markup=following.keyboard)
 
 @bot.callback_query_handler(func=lambda call: call.data in ('1', '2', '3', '4', '5', '6'))
 def dice_callback(call):
-    value = bot.send_dice(call.message.chat.id, emoji='🎲').dice.value
+    value = send_dice(call.message.chat.id, emoji='🎲').result().dice.value
     if str(value) == call.data:
-        bot.send_message(call.message.chat.id, "Ты угадал!")
+        send_message(call.message.chat.id, "Ты угадал!")
     else:
-        bot.send_message(call.message.chat.id, "Попробуй еще раз")
+        send_message(call.message.chat.id, "Попробуй еще раз")
 
 
 if __name__ == '__main__':
-    server_url = os.getenv("RENDER_EXTERNAL_URL")
-    if server_url and API_TOKEN:
-        webhook_url = f"{server_url.rstrip('/')}/{API_TOKEN}"
+    if SERVER_URL and API_TOKEN:
+        webhook_url = f"{SERVER_URL.rstrip('/')}/{API_TOKEN}"
 
         try:
-            r = requests.get(f"https://api.telegram.org/bot{API_TOKEN}/setWebhook",
-                             params={"url": webhook_url}, timeout=10)
+            r = http_client.telegram_session.get(f"https://api.telegram.org/bot{API_TOKEN}/setWebhook",
+                                        params={"url": webhook_url}, timeout=http_client.timeout(10))
             logging.info(f"Вебхук установлен: {r.text}")
         except Exception:
             logging.exception("Ошибка при установке webhook")
@@ -456,6 +738,11 @@ if __name__ == '__main__':
         logging.info(f"Запуск на порте {port}")
         app.run(host='0.0.0.0', port=port)
     else:
-        logging.info("Запуск бота в режиме pooling")
         bot.remove_webhook()
-        bot.infinity_polling(timeout=60)
+        if BATCH_POLLING:
+            logging.info(f"Запуск бота в режиме пакетного polling: {update_pool.workers} потоков, "
+                         f"{INFERENCE_PROCESSES} процессов инференса")
+            poller.run()
+        else:
+            logging.info("Запуск бота в режиме pooling")
+            bot.infinity_polling(timeout=60)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+TFLITE_THREADS = int(os.getenv("TFLITE_THREADS", 0)) or None
+
+
+def load_interpreter(model_path):
+    # tflite_runtime весит несколько мегабайт против сотен у tensorflow,
+    # поэтому tensorflow импортируется только если его нет.
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=TFLITE_THREADS)
+
+
+class TFLiteModel:
+    # Не потокобезопасен: вызывается только из потока MicroBatcher.
+
+    def __init__(self, model_path):
+        self.path = model_path
+        self.interpreter = load_interpreter(model_path)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = int(self.input_details[0]['shape'][0])
+        self.item_shape = tuple(int(d) for d in self.input_details[0]['shape'][1:])
+        self.batchable = True
+
+    def _resize(self, batch_size):
+        if self.batch_size == batch_size:
+            return
+        shape = list(self.input_details[0]['shape'])
+        shape[0] = batch_size
+        self.interpreter.resize_tensor_input(self.input_details[0]['index'], shape)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = batch_size
+
+    def _invoke(self, x):
+        self.interpreter.set_tensor(self.input_details[0]['index'], x)
+        self.interpreter.invoke()
+        pred = self.interpreter.get_tensor(self.output_details[0]['index'])
+        return pred.reshape(pred.shape[0], -1)
+
+    def predict(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape((len(x), *self.item_shape))
+        if self.batchable:
+            try:
+                self._resize(len(x))
+                return self._invoke(x)
+            except Exception as e:
+                logging.warning(f"TFLite модель {self.path} не поддерживает батчи, инференс по одному: {e}")
+                self.batchable = False
+        self._resize(1)
+        return np.concatenate([self._invoke(item[None, ...]) for item in x])
+
+
+class KerasModel:
+    def __init__(self, model_path):
+        from tensorflow.keras.models import load_model
+        self.path = model_path
+        self.model = load_model(model_path, compile=False)
+
+    def predict(self, x):
+        pred = self.model.predict(x, verbose=0)
+        return pred.reshape(pred.shape[0], -1)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_info_path(tflite_path):
+    return tflite_path + ".source"
+
+
+_converted = {}
+
+
+def converted_from(tflite_path, source_path):
+    # Сконвертирован ли tflite_path из текущей версии source_path: при конвертации
+    # рядом записывается хэш исходника. Результат кэшируется до изменения файлов.
+    info_path = source_info_path(tflite_path)
+    try:
+        key = tuple((s.st_mtime_ns, s.st_size) for s in map(os.stat, (tflite_path, source_path, info_path)))
+    except FileNotFoundError:
+        return False
+    cached = _converted.get((tflite_path, source_path))
+    if cached and cached[0] == key:
+        return cached[1]
+    try:
+        with open(info_path, "r", encoding="utf-8") as f:
+            current = json.load(f).get("sha256") == file_sha256(source_path)
+    except (OSError, ValueError):
+        current = False
+    _converted[(tflite_path, source_path)] = (key, current)
+    return current
+
+
+def convert_keras_to_tflite(h5_path, tflite_path):
+    from tensorflow.keras.models import load_model
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(load_model(h5_path, compile=False))
+    with open(tflite_path, "wb") as f:
+        f.write(converter.convert())
+    with open(source_info_path(tflite_path), "w", encoding="utf-8") as f:
+        json.dump({"source": os.path.basename(h5_path), "sha256": file_sha256(h5_path)}, f)
+
+
+if __name__ == "__main__":
+    # python models.py mnist_model.h5 mnist_model.tflite
+    if len(sys.argv) != 3:
+        sys.exit("Использование: python models.py <model.h5> <model.tflite>")
+    convert_keras_to_tflite(sys.argv[1], sys.argv[2])
+    print(f"Сохранено: {sys.argv[2]}")
@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        # Сколько ждать до появления токена; 0 — токен есть.
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+def retry_after(error):
+    # Telegram в ответе 429 передает parameters.retry_after
+    result = getattr(error, "result_json", None) or {}
+    if getattr(error, "error_code", None) != 429 and result.get("error_code") != 429:
+        return None
+    return float((result.get("parameters") or {}).get("retry_after", 1))
+
+
+class _Item:
+    __slots__ = ("fn", "args", "kwargs", "futures", "ready_at", "text")
+
+    def __init__(self, fn, args, kwargs, ready_at, text=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [Future()]
+        self.ready_at = ready_at
+        self.text = text
+
+
+class _Chat:
+    __slots__ = ("items", "bucket", "busy", "paused_until")
+
+    def __init__(self, bucket):
+        self.items = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.paused_until = 0.0
+
+
+class Outbox:
+    # Исходящие вызовы Telegram с лимитами на чат и общим лимитом (token bucket).
+    # В пределах чата порядок сохраняется; подряд идущие тексты в один чат,
+    # пришедшие в течение merge_window_ms, склеиваются в одно сообщение.
+
+    def __init__(self, send_message, global_rate=30, chat_rate=1, chat_burst=3,
+                 merge_window_ms=50, max_len=4096, workers=4):
+        self.send_message_fn = send_message
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.merge_window = merge_window_ms / 1000.0
+        self.max_len = max_len
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="outbox-send")
+        self._thread = None
+
+    def send_message(self, chat_id, text, **kwargs):
+        mergeable = "reply_markup" not in kwargs and "reply_to_message_id" not in kwargs
+        return self._enqueue(chat_id, self.send_message_fn, (chat_id, text), kwargs,
+                             text if mergeable else None)
+
+    def call(self, chat_id, fn, *args, **kwargs):
+        return self._enqueue(chat_id, fn, args, kwargs, None)
+
+    def pending(self):
+        with self._cond:
+            return self._size
+
+    def _enqueue(self, chat_id, fn, args, kwargs, text):
+        delay = self.merge_window if text is not None else 0
+        item = _Item(fn, args, kwargs, time.monotonic() + delay, text)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="outbox", daemon=True)
+                self._thread.start()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+            chat.items.append(item)
+            self._size += 1
+            self._cond.notify()
+        return item.futures[0]
+
+    def _merge(self, chat):
+        item = chat.items.popleft()
+        self._size -= 1
+        if item.text is None:
+            return item
+        while chat.items:
+            following = chat.items[0]
+            if (following.text is None or following.kwargs != item.kwargs
+                    or len(item.text) + 2 + len(following.text) > self.max_len):
+                break
+            chat.items.popleft()
+            self._size -= 1
+            item.text = f"{item.text}\n\n{following.text}"
+            item.args = (item.args[0], item.text)
+            item.futures.extend(following.futures)
+        return item
+
+    def _next(self):
+        # Выбирает чат, который можно обслужить сейчас, или время до ближайшей возможности.
+        now = time.monotonic()
+        wait = None
+        global_wait = self._global.wait_time(now)
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.items:
+                if not chat.busy and chat.bucket.wait_time(now) == 0 and chat.bucket.tokens >= chat.bucket.capacity:
+                    del self._chats[chat_id]
+                continue
+            if chat.busy:
+                continue
+            chat_wait = max(chat.paused_until - now, chat.items[0].ready_at - now,
+                            chat.bucket.wait_time(now), global_wait, 0)
+            if chat_wait == 0:
+                self._global.take()
+                chat.bucket.take()
+                chat.busy = True
+                return (chat_id, chat, self._merge(chat)), 0
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                picked, wait = self._next()
+                while picked is None:
+                    self._cond.wait(wait)
+                    picked, wait = self._next()
+            self._pool.submit(self._deliver, *picked)
+
+    def _deliver(self, chat_id, chat, item):
+        try:
+            result = item.fn(*item.args, **item.kwargs)
+        except Exception as e:
+            pause = retry_after(e)
+            if pause is not None:
+                logging.warning(f"Telegram 429 для чата {chat_id}, пауза {pause} с")
+                with self._cond:
+                    chat.paused_until = time.monotonic() + pause
+                    chat.items.appendleft(item)
+                    self._size += 1
+                    chat.busy = False
+                    self._cond.notify()
+                return
+            logging.error(f"Ошибка отправки в чат {chat_id}: {e}")
+            for future in item.futures:
+                future.set_exception(e)
+        else:
+            for future in item.futures:
+                future.set_result(result)
+        with self._cond:
+            chat.busy = False
+            self._cond.notify()
+
+
+class OutboxBot:
+    # Синхронные вызовы бота через Outbox — с теми же лимитами и паузами при 429.
+    # Подставляется вместо bot туда, где нужен результат вызова (StreamingReply).
+
+    def __init__(self, outbox, bot):
+        self.outbox = outbox
+        self.bot = bot
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.outbox.call(chat_id, self.bot.send_message, chat_id, text, **kwargs).result()
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.outbox.call(chat_id, self.bot.edit_message_text, text, chat_id, message_id, **kwargs).result()
+
+    def delete_message(self, chat_id, message_id):
+        return self.outbox.call(chat_id, self.bot.delete_message, chat_id, message_id).result()
@@ -0,0 +1,48 @@
+import logging
+import random
+import time
+
+MAX_LIMIT = 100
+
+
+class BatchPoller:
+    # getUpdates пачками до limit апдейтов; каждый апдейт уходит в OrderedWorkerPool
+    # по ключу чата. offset сдвигается только после того, как апдейт принят в очередь,
+    # поэтому при заполненной очереди чтение из Telegram приостанавливается.
+
+    def __init__(self, bot, pool, key, limit=MAX_LIMIT, long_poll=30, allowed_updates=None, queue_timeout=1):
+        self.bot = bot
+        self.pool = pool
+        self.key = key
+        self.limit = max(1, min(limit, MAX_LIMIT))
+        self.long_poll = long_poll
+        self.allowed_updates = allowed_updates
+        self.queue_timeout = queue_timeout
+        self.offset = None
+        self._running = False
+
+    def poll_once(self):
+        updates = self.bot.get_updates(offset=self.offset, limit=self.limit, timeout=self.long_poll + 5,
+                                       allowed_updates=self.allowed_updates, long_polling_timeout=self.long_poll)
+        for update in updates:
+            while not self.pool.submit(self.key(update), update, self.queue_timeout):
+                if not self._running:
+                    return
+            self.offset = update.update_id + 1
+
+    def run(self):
+        self._running = True
+        errors = 0
+        while self._running:
+            try:
+                self.poll_once()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                delay = random.uniform(0, min(2 ** errors, 60))
+                logging.error(f"Ошибка getUpdates, повтор через {delay:.1f} с: {e}")
+                time.sleep(delay)
+
+    def stop(self):
+        # Текущий long polling запрос доработает до конца.
+        self._running = False
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def file_version(path):
+    # Хэш файла модели; пересчитывается только при изменении mtime или размера.
+    stat = os.stat(path)
+    with _versions_lock:
+        cached = _versions.get(path)
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    version = f"{os.path.basename(path)}:{digest.hexdigest()[:16]}"
+    with _versions_lock:
+        _versions[path] = ((stat.st_mtime_ns, stat.st_size), version)
+    return version
+
+
+def image_hash(photo):
+    # sha256 скачанных байтов: только точное совпадение. Перцептивный хэш по уменьшенной
+    # копии путал разные цифры и возвращал ответ для чужого фото.
+    return hashlib.sha256(photo).hexdigest()
+
+
+class PredictionCache:
+    # Результаты моделей по file_unique_id и по хэшу изображения, с LRU-вытеснением.
+    # Запись с другой версией модели считается отсутствующей и удаляется.
+
+    def __init__(self, path, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "model TEXT NOT NULL, key TEXT NOT NULL, version TEXT NOT NULL, result TEXT NOT NULL, "
+            "accessed REAL NOT NULL, PRIMARY KEY (model, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS predictions_accessed ON predictions (accessed)")
+
+    def get(self, model, key, version):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, result FROM predictions WHERE model = ? AND key = ?", (model, key)
+            ).fetchone()
+            if row is None or row[0] != version:
+                if row is not None:
+                    self._conn.execute("DELETE FROM predictions WHERE model = ? AND key = ?", (model, key))
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE predictions SET accessed = ? WHERE model = ? AND key = ?", (time.time(), model, key))
+            self.hits += 1
+            return json.loads(row[1])
+
+    def set(self, model, keys, version, result):
+        raw = json.dumps(result)
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO predictions (model, key, version, result, accessed) "
+                "VALUES (?, ?, ?, ?, ?)", [(model, key, version, raw, now) for key in keys])
+            self._inserts += len(keys)
+            if self._inserts < 100:
+                return
+            self._inserts = 0
+            self._conn.execute(
+                "DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "size": size}
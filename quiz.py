@@ -0,0 +1,61 @@
+import json
+from collections import namedtuple
+
+from telebot import types
+
+PREFIX = "quiz:"
+
+Question = namedtuple("Question", "qid text choices answer reward next correct wrong keyboard")
+
+
+def callback_data(qid, choice):
+    return f"{PREFIX}{qid}:{choice}"
+
+
+def _keyboard(qid, choices, row_width):
+    markup = types.InlineKeyboardMarkup(row_width=row_width)
+    markup.add(*(types.InlineKeyboardButton(text, callback_data=callback_data(qid, i))
+                 for i, text in enumerate(choices)))
+    # Клавиатура сериализуется один раз; telebot отправляет строку reply_markup как есть.
+    return markup.to_json()
+
+
+class Quiz:
+    # Викторина из файла данных: вопросы по qid, готовые клавиатуры и
+    # разбор callback_data вида quiz:<qid>:<номер ответа> одним поиском в словаре.
+
+    def __init__(self, data, row_width=2):
+        self.start = data["start"]
+        self.min_balance = data.get("min_balance", 0)
+        self.questions = {}
+        for qid, q in data["questions"].items():
+            if ":" in qid:
+                raise ValueError(f"Недопустимый id вопроса: {qid}")
+            self.questions[qid] = Question(
+                qid, q["text"], tuple(q["choices"]), q["answer"], q.get("reward", 0), q.get("next"),
+                q["correct"], q["wrong"], _keyboard(qid, q["choices"], q.get("row_width", row_width)))
+        for q in self.questions.values():
+            if q.next is not None and q.next not in self.questions:
+                raise ValueError(f"Вопрос {q.qid} ссылается на неизвестный {q.next}")
+            if len(callback_data(q.qid, len(q.choices) - 1).encode()) > 64:
+                raise ValueError(f"callback_data вопроса {q.qid} длиннее 64 байт")
+        if self.start not in self.questions:
+            raise ValueError(f"Неизвестный первый вопрос: {self.start}")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def first(self):
+        return self.questions[self.start]
+
+    def parse(self, data):
+        # (вопрос, выбран ли верный ответ) или None для чужих и устаревших кнопок.
+        if not data.startswith(PREFIX):
+            return None
+        qid, _, choice = data[len(PREFIX):].rpartition(":")
+        question = self.questions.get(qid)
+        if question is None or not choice.isdigit() or int(choice) >= len(question.choices):
+            return None
+        return question, int(choice) == question.answer
@@ -0,0 +1,70 @@
+def normalize(text):
+    # Регистр и лишние пробелы не важны: "  помощь " и "Помощь" — одна команда.
+    return " ".join(text.split()).casefold()
+
+
+def command_name(text):
+    # "/start@my_bot arg" -> "start"; для обычного текста None.
+    if not text.startswith("/"):
+        return None
+    parts = text[1:].split(maxsplit=1)
+    return parts[0].split("@")[0].casefold() if parts else None
+
+
+class Router:
+    # Текстовые сообщения разбираются поиском в словарях, без перебора условий:
+    # сначала слэш-команда, затем обработчик текущего состояния пользователя,
+    # затем кнопка меню (с алиасами), иначе обработчик по умолчанию.
+
+    def __init__(self, get_state=None):
+        self.get_state = get_state
+        self._commands = {}
+        self._texts = {}
+        self._exact = {}
+        self._states = {}
+        self._default = None
+
+    def _register(self, table, keys, handler):
+        for key in keys:
+            if key in table:
+                raise ValueError(f"Повторная регистрация: {key}")
+            table[key] = handler
+        return handler
+
+    def command(self, *names):
+        return lambda handler: self._register(self._commands, [n.casefold() for n in names], handler)
+
+    def text(self, *labels):
+        def register(handler):
+            self._register(self._texts, [normalize(label) for label in labels], handler)
+            self._exact.update((label, handler) for label in labels)
+            return handler
+        return register
+
+    def state(self, *states):
+        return lambda handler: self._register(self._states, states, handler)
+
+    def default(self, handler):
+        self._default = handler
+        return handler
+
+    def resolve(self, message):
+        text = message.text or ""
+        if text[:1] == "/":
+            handler = self._commands.get(command_name(text))
+            if handler is not None:
+                return handler
+        if self._states and self.get_state is not None:
+            handler = self._states.get(self.get_state(message))
+            if handler is not None:
+                return handler
+        # Нажатие кнопки приходит ровно с ее текстом, нормализация нужна только при промахе.
+        handler = self._exact.get(text)
+        if handler is None:
+            handler = self._texts.get(normalize(text), self._default)
+        return handler
+
+    def dispatch(self, message):
+        handler = self.resolve(message)
+        if handler is not None:
+            return handler(message)
@@ -0,0 +1,321 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+_MISSING = object()
+
+
+class Storage:
+    # Хранилище записей в SQLite (WAL). Изменения копятся в памяти и
+    # сбрасываются одной транзакцией раз в flush_interval_ms.
+    # Рассчитано на один процесс; для нескольких воркеров — RedisStorage.
+
+    shared = False
+
+    def __init__(self, path, flush_interval_ms=200, on_flush=None):
+        self.path = path
+        self.flush_interval = flush_interval_ms / 1000.0
+        # on_flush(секунды, число записей) — для метрик
+        self.on_flush = on_flush
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._db_lock = threading.Lock()
+        self._pending = {}
+        self._inflight = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name="storage-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def get(self, namespace, key, default=None):
+        with self._pending_lock:
+            raw = self._pending.get((namespace, key), _MISSING)
+            if raw is _MISSING:
+                raw = self._inflight.get((namespace, key), _MISSING)
+        if raw is _MISSING:
+            with self._db_lock:
+                row = self._conn.execute(
+                    "SELECT value FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+            raw = row[0] if row else None
+        return default if raw is None else json.loads(raw)
+
+    def put(self, namespace, key, value):
+        raw = json.dumps(value, ensure_ascii=False)
+        with self._pending_lock:
+            self._pending[(namespace, key)] = raw
+        self._wakeup.set()
+
+    def delete(self, namespace, key):
+        with self._pending_lock:
+            self._pending[(namespace, key)] = None
+        self._wakeup.set()
+
+    def update(self, namespace, key, fn):
+        # Атомарное чтение-изменение-запись: fn получает текущее значение (или None).
+        with self._update_lock:
+            value = fn(self.get(namespace, key))
+            self.put(namespace, key, value)
+            return value
+
+    def pop(self, namespace, key):
+        with self._update_lock:
+            value = self.get(namespace, key)
+            if value is not None:
+                self.delete(namespace, key)
+            return value
+
+    def keys(self, namespace):
+        with self._db_lock:
+            stored = {row[0] for row in self._conn.execute(
+                "SELECT key FROM records WHERE namespace = ?", (namespace,))}
+        with self._pending_lock:
+            for (ns, key), raw in (*self._inflight.items(), *self._pending.items()):
+                if ns != namespace:
+                    continue
+                if raw is None:
+                    stored.discard(key)
+                else:
+                    stored.add(key)
+        return stored
+
+    def pending(self):
+        with self._pending_lock:
+            return len(self._pending)
+
+    def count(self, namespace):
+        return len(self.keys(namespace))
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._inflight = pending
+        if not pending:
+            return
+        start = time.perf_counter()
+        upserts = [(ns, key, raw) for (ns, key), raw in pending.items() if raw is not None]
+        deletes = [(ns, key) for (ns, key), raw in pending.items() if raw is None]
+        try:
+            with self._db_lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT INTO records (namespace, key, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value", upserts)
+                    self._conn.executemany(
+                        "DELETE FROM records WHERE namespace = ? AND key = ?", deletes)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            if self.on_flush:
+                self.on_flush(time.perf_counter() - start, len(pending))
+        except Exception as e:
+            logging.error(f"Ошибка записи в хранилище: {e}")
+            with self._pending_lock:
+                for item, raw in pending.items():
+                    self._pending.setdefault(item, raw)
+        finally:
+            with self._pending_lock:
+                self._inflight = {}
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self.flush_interval and not self._closed:
+                time.sleep(self.flush_interval)
+            self.flush()
+
+    def import_json(self, namespace, json_path):
+        # Разовый перенос старых db.json/history.json в хранилище.
+        if not os.path.exists(json_path) or self.count(namespace):
+            return
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.error(f"Не удалось импортировать {json_path}: {e}")
+            return
+        for key, value in data.items():
+            self.put(namespace, str(key), value)
+        self.flush()
+        logging.info(f"Импортировано {len(data)} записей из {json_path}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join(timeout=5)
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+class RedisStorage:
+    # Тот же интерфейс поверх Redis: каждая запись — отдельный ключ
+    # <prefix><namespace>:<key>, запись сразу уходит в Redis, поэтому
+    # состояние видят все процессы бота.
+
+    shared = True
+
+    def __init__(self, url, prefix="fortgbot:", client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("Для STORAGE_URL=redis://... нужен пакет redis")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.on_flush = None
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}{namespace}:{key}"
+
+    def get(self, namespace, key, default=None):
+        raw = self.client.get(self._key(namespace, key))
+        return default if raw is None else json.loads(raw)
+
+    def put(self, namespace, key, value):
+        self.client.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False))
+
+    def delete(self, namespace, key):
+        self.client.delete(self._key(namespace, key))
+
+    def update(self, namespace, key, fn):
+        import redis
+        name = self._key(namespace, key)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.get(name)
+                    value = fn(None if raw is None else json.loads(raw))
+                    pipe.multi()
+                    pipe.set(name, json.dumps(value, ensure_ascii=False))
+                    pipe.execute()
+                    return value
+                except redis.WatchError:
+                    continue
+
+    def pop(self, namespace, key):
+        name = self._key(namespace, key)
+        with self.client.pipeline() as pipe:
+            pipe.get(name)
+            pipe.delete(name)
+            raw, _ = pipe.execute()
+        return None if raw is None else json.loads(raw)
+
+    def keys(self, namespace):
+        start = len(self._key(namespace, ""))
+        return {name.decode("utf-8")[start:] if isinstance(name, bytes) else name[start:]
+                for name in self.client.scan_iter(match=self._key(namespace, "*"), count=1000)}
+
+    def count(self, namespace):
+        return len(self.keys(namespace))
+
+    def pending(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.client.close()
+
+    import_json = Storage.import_json
+
+
+def create_storage(url, flush_interval_ms=200, on_flush=None):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStorage(url)
+    return Storage(url, flush_interval_ms, on_flush)
+
+
+class StoredDict(MutableMapping):
+    # Словарь поверх Storage: записи читаются из базы при первом обращении.
+    # После изменения вложенных полей нужно вызвать save(key) или использовать modify().
+    # Над общим хранилищем (shared) записи не кэшируются: их меняют и другие процессы.
+
+    def __init__(self, storage, namespace):
+        self.storage = storage
+        self.namespace = namespace
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def _load(self, key):
+        if self.storage.shared:
+            return self.storage.get(self.namespace, key, _MISSING)
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = self.storage.get(self.namespace, key, _MISSING)
+                self._cache[key] = value
+            return value
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._load(key) is not _MISSING
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if not self.storage.shared:
+                self._cache[key] = value
+            self.storage.put(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self._load(key) is _MISSING:
+                raise KeyError(key)
+            if not self.storage.shared:
+                self._cache[key] = _MISSING
+            self.storage.delete(self.namespace, key)
+
+    def __iter__(self):
+        return iter(self.storage.keys(self.namespace))
+
+    def __len__(self):
+        return self.storage.count(self.namespace)
+
+    def save(self, key):
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                self.storage.put(self.namespace, key, value)
+
+    def modify(self, key, fn):
+        with self._lock:
+            value = self.storage.update(self.namespace, key, fn)
+            if not self.storage.shared:
+                self._cache[key] = value
+            return value
+
+    def evict(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
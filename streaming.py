@@ -0,0 +1,172 @@
+import json
+import logging
+import time
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def iter_sse_content(response):
+    # Разбирает SSE-поток /chat/completions и возвращает куски content.
+    # SSE всегда в UTF-8, а requests для text/event-stream без charset взял бы ISO-8859-1.
+    for raw in response.iter_lines():
+        line = raw.decode("utf-8", errors="replace")
+        if not line or not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            break
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            logging.warning(f"Некорректный кусок SSE: {payload[:200]}")
+            continue
+        if chunk.get("error"):
+            raise RuntimeError(f"Ошибка API: {json.dumps(chunk['error'], ensure_ascii=False)}")
+        for choice in chunk.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
+
+
+def strip_think(content):
+    # Ответ без рассуждений: все после первого </think> (открывающего тега может и не быть).
+    # Если блок <think> так и не закрылся, ответом считаются сами рассуждения без тега.
+    if THINK_CLOSE in content:
+        return content.split(THINK_CLOSE, 1)[1]
+    stripped = content.lstrip()
+    if stripped.startswith(THINK_OPEN):
+        return stripped[len(THINK_OPEN):]
+    return content
+
+
+def _partial_close(text):
+    # Длина хвоста text, который может оказаться началом </think>.
+    for size in range(min(len(text), len(THINK_CLOSE) - 1), 0, -1):
+        if THINK_CLOSE.startswith(text[-size:]):
+            return size
+    return 0
+
+
+class ThinkFilter:
+    # Потоковый вариант strip_think: feed возвращает (reset, visible), где reset значит,
+    # что показанный раньше текст был рассуждениями без <think> и его нужно убрать.
+    # Склейка всех visible после последнего reset и finish() совпадает со strip_think.
+
+    def __init__(self):
+        self._buffer = ""
+        self._state = "start"
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        reset = False
+        if self._state == "start":
+            stripped = self._buffer.lstrip()
+            if not stripped or (len(stripped) < len(THINK_OPEN) and THINK_OPEN.startswith(stripped)):
+                return False, ""
+            if stripped.startswith(THINK_OPEN):
+                self._state = "think"
+                self._buffer = stripped[len(THINK_OPEN):]
+            else:
+                self._state = "answer"
+        if self._state in ("think", "answer"):
+            end = self._buffer.find(THINK_CLOSE)
+            if end != -1:
+                reset = self._state == "answer"
+                self._state = "done"
+                self._buffer = self._buffer[end + len(THINK_CLOSE):]
+            elif self._state == "think":
+                # рассуждения копятся целиком: если блок не закроется, они и будут ответом
+                return False, ""
+            else:
+                keep = _partial_close(self._buffer)
+                visible = self._buffer[:len(self._buffer) - keep]
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                return False, visible
+        visible, self._buffer = self._buffer, ""
+        return reset, visible
+
+    def finish(self):
+        visible, self._buffer = self._buffer, ""
+        return visible
+
+
+class StreamingReply:
+    # Показывает ответ по мере генерации, редактируя сообщение-заглушку
+    # не чаще раза в edit_interval секунд. Длинный ответ продолжается в новом сообщении.
+
+    def __init__(self, bot, chat_id, message_id, formatter, max_len=4096, edit_interval=1.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.formatter = formatter
+        self.max_len = max_len
+        self.edit_interval = edit_interval
+        self.text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self._previous = []
+
+    def feed(self, chunk):
+        self.text += chunk
+        while len(self.text) > self.max_len:
+            cut = self._split_point(self.text)
+            self._edit(self.text[:cut], final=True)
+            self.text = self.text[cut:].lstrip()
+            self._previous.append(self.message_id)
+            self.message_id = self.bot.send_message(self.chat_id, "...").message_id
+            self._shown = ""
+        if time.monotonic() - self._last_edit >= self.edit_interval:
+            self._edit(self.text)
+
+    def finish(self):
+        if self.text.strip():
+            self._edit(self.text, final=True)
+        else:
+            self._delete()
+
+    def fail(self):
+        self._delete()
+
+    def reset(self):
+        # Показанное оказалось рассуждениями: удаляем продолжения и возвращаем заглушку.
+        for message_id in self._previous:
+            self._delete(message_id)
+        self._previous = []
+        self.text = ""
+        if self._shown:
+            self._edit("...", final=True)
+            self._shown = ""
+
+    def _split_point(self, text):
+        for sep in ("\n\n", "\n", ". ", " "):
+            cut = text.rfind(sep, 0, self.max_len)
+            if cut > self.max_len // 2:
+                return cut + len(sep)
+        return self.max_len
+
+    def _edit(self, text, final=False):
+        self._last_edit = time.monotonic()
+        if not text.strip() or (text == self._shown and not final):
+            return
+        try:
+            if final:
+                html = self.formatter(text)
+                if len(html) <= self.max_len:
+                    try:
+                        self.bot.edit_message_text(html, self.chat_id, self.message_id, parse_mode="HTML")
+                        self._shown = text
+                        return
+                    except Exception as e:
+                        logging.warning(f"Не удалось отправить ответ в HTML: {e}")
+            self.bot.edit_message_text(text, self.chat_id, self.message_id)
+            self._shown = text
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                logging.error(f"Ошибка редактирования сообщения: {e}")
+
+    def _delete(self, message_id=None):
+        try:
+            self.bot.delete_message(self.chat_id, message_id or self.message_id)
+        except Exception:
+            pass
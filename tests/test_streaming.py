@@ -0,0 +1,73 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import StreamingReply, ThinkFilter, strip_think  # noqa: E402
+
+
+def run(chunks):
+    # То, что увидит пользователь: visible после последнего reset и хвост из finish().
+    think = ThinkFilter()
+    shown = ""
+    for chunk in chunks:
+        reset, visible = think.feed(chunk)
+        if reset:
+            shown = ""
+        shown += visible
+    return shown + think.finish()
+
+
+def test_closed_block_is_hidden():
+    assert run(["<thi", "nk>думаю</th", "ink>Ответ"]) == "Ответ"
+
+
+def test_close_without_open_drops_shown_text():
+    assert run(["Хм, подумаем", "...</think>", "Ответ"]) == "Ответ"
+
+
+def test_unclosed_block_matches_strip_think():
+    chunks = ["<think>", "думаю и ", "не заканчиваю"]
+    assert run(chunks) == strip_think("".join(chunks)) == "думаю и не заканчиваю"
+
+
+def test_plain_answer_passes_through():
+    assert run(["  Прос", "то ответ </", "b>"]) == "  Просто ответ </b>"
+
+
+def test_every_split_matches_strip_think():
+    for content in ["<think>a</think>b</think>c", "a</think>b", "  <think>a", "a </thin b", "<thin", ""]:
+        for cut in range(len(content) + 1):
+            for cut2 in range(cut, len(content) + 1):
+                chunks = [content[:cut], content[cut:cut2], content[cut2:]]
+                assert run(chunks) == strip_think(content), (content, chunks)
+
+
+class FakeBot:
+    def __init__(self):
+        self.texts = {}
+        self.next_id = 2
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.next_id += 1
+        self.texts[self.next_id] = text
+        return SimpleNamespace(message_id=self.next_id)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.texts[message_id] = text
+
+    def delete_message(self, chat_id, message_id):
+        del self.texts[message_id]
+
+
+def test_reply_reset_removes_shown_reasoning():
+    bot = FakeBot()
+    bot.texts[1] = "..."
+    reply = StreamingReply(bot, 10, 1, str, max_len=20, edit_interval=0)
+    reply.feed("рассуждения " * 4)
+    assert len(bot.texts) > 1
+    reply.reset()
+    reply.feed("Ответ")
+    reply.finish()
+    assert list(bot.texts.values()) == ["Ответ"]
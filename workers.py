@@ -0,0 +1,78 @@
+import logging
+import threading
+from collections import deque
+
+
+class OrderedWorkerPool:
+    # Пул потоков с ограниченной очередью: задачи с одним ключом (chat_id)
+    # выполняются строго по очереди, задачи с разными ключами — параллельно.
+
+    def __init__(self, handler, workers=8, max_pending=1000, name="worker"):
+        if workers < 1:
+            raise ValueError("workers должен быть >= 1")
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.name = name
+        self._pending = {}
+        self._ready = deque()
+        self._size = 0
+        self._active = 0
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, item, timeout=0):
+        # Возвращает False, если очередь переполнена и место не освободилось за timeout.
+        with self._cond:
+            self._ensure_started()
+            if self._size >= self.max_pending and timeout:
+                self._cond.wait_for(lambda: self._size < self.max_pending, timeout)
+            if self._size >= self.max_pending:
+                return False
+            self._size += 1
+            items = self._pending.get(key)
+            if items is None:
+                self._pending[key] = deque([item])
+                self._ready.append(key)
+                self._cond.notify_all()
+            else:
+                items.append(item)
+            return True
+
+    def pending(self):
+        with self._cond:
+            return self._size
+
+    def in_flight(self):
+        with self._cond:
+            return self._active
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready)
+                key = self._ready.popleft()
+                item = self._pending[key][0]
+                self._active += 1
+            try:
+                self.handler(item)
+            except Exception as e:
+                logging.exception(f"Ошибка в {self.name}: {e}")
+            with self._cond:
+                self._active -= 1
+                self._size -= 1
+                items = self._pending[key]
+                items.popleft()
+                if items:
+                    self._ready.append(key)
+                else:
+                    del self._pending[key]
+                self._cond.notify_all()